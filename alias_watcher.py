@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+r"""alias_watcher.py.
+
+This file implements the hot reload of the command aliases
+- polls the mtimes of aliases.yaml, the scripts dir and every script in it
+- on a change, rebuilds the alias table in a worker thread and lets the
+  Config swap it in atomically
+
+"""
+
+import asyncio
+import logging
+import os
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class AliasWatcher(object):
+    """Reload the aliases of a Config whenever its sources change."""
+
+    def __init__(self, config, interval: float):
+        """Initialize.
+
+        Arguments:
+        ---------
+            config (Config): Bot configuration parameters
+            interval (float): seconds between two checks
+
+        """
+        self.config = config
+        self.interval = interval
+        self._snapshot = self._take_snapshot()
+        self._task = None
+
+    def start(self):
+        """Start watching in the background."""
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.ensure_future(self._watch())
+
+    async def stop(self):
+        """Stop watching."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                snapshot = await loop.run_in_executor(
+                    None, self._take_snapshot)
+                if snapshot == self._snapshot:
+                    continue
+                logger.debug("Aliases or scripts changed, reloading.")
+                self._snapshot = snapshot
+                await loop.run_in_executor(None, self.config.reload_aliases)
+            except Exception:
+                logger.exception("Checking the aliases for changes failed")
+
+    def _take_snapshot(self) -> Dict[str, Tuple[int, int, int]]:
+        """Return path -> (mtime, size, mode) of everything we load from."""
+        snapshot = {}
+        paths = [self.config.aliases_yaml, self.config.scripts_dir]
+        try:
+            paths += [
+                os.path.join(self.config.scripts_dir, name)
+                for name in os.listdir(self.config.scripts_dir)
+            ]
+        except OSError:
+            pass
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_mtime_ns, st.st_size, st.st_mode)
+        return snapshot
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+r"""callbacks_bench.py.
+
+This file implements a throughput benchmark of the whole command path
+- Callbacks, the Dispatcher, Command, the ScriptExecutor, Storage and the
+  chat functions are the real ones, only nio.AsyncClient is replaced by
+  an in-memory stand-in that records room_send() and upload() calls and
+  answers them after a configurable simulated latency
+- thousands of synthetic RoomMessageText events spread over many rooms
+  are fed through Callbacks.message as fast as it accepts them
+- for builtins (echo), an aliased script and an image command it reports
+  events/s, p50 and p99 of the time from an event to its reply, and the
+  peak memory
+
+Run it from the repository root:
+    python benchmarks/callbacks_bench.py [--events N] [--rooms N]
+        [--latency MS] [--scenario builtin|script|image]
+
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yaml  # noqa: E402
+from nio import (  # noqa: E402
+    MatrixRoom,
+    RoomMessageText,
+    RoomSendResponse,
+    UploadResponse,
+)
+from PIL import Image  # noqa: E402
+
+from callbacks import Callbacks  # noqa: E402
+from chat_functions import outbox  # noqa: E402
+from command_history import CommandHistory  # noqa: E402
+from config import Config  # noqa: E402
+from dispatcher import Dispatcher  # noqa: E402
+from executor import ScriptExecutor  # noqa: E402
+from result_cache import ResultCache  # noqa: E402
+from storage import Storage  # noqa: E402
+
+BOT_USER = "@k9:bench.example"
+PREFIX = "!c "
+
+# scenario -> command sent, #<n> is replaced by the number of the event
+SCENARIOS = {
+    "builtin": "echo #{n}",
+    "script": "bench #{n}",
+    "image": "img #{n}",
+}
+
+# replies to text commands carry the number of their event
+TOKEN_RE = re.compile(r"#(\d+)")
+
+
+class FakeClient(object):
+    """In-memory stand-in for nio.AsyncClient."""
+
+    def __init__(self, latency: float):
+        """Initialize.
+
+        Arguments:
+        ---------
+            latency (float): seconds every request takes
+
+        """
+        self.user = BOT_USER
+        self.latency = latency
+        self.sends = 0
+        self.uploads = 0
+        # called with (room_id, content) for every message sent
+        self.on_send = None
+
+    async def room_send(self, room_id, message_type, content,
+                        ignore_unverified_devices=False):
+        await asyncio.sleep(self.latency)
+        self.sends += 1
+        self.on_send(room_id, content)
+        return RoomSendResponse(f"$event{self.sends}", room_id)
+
+    async def upload(self, data_provider, content_type="application/octet-stream",
+                     filename=None, encrypt=False, monitor=None,
+                     filesize=None):
+        await asyncio.sleep(self.latency)
+        self.uploads += 1
+        return UploadResponse(f"mxc://bench.example/{self.uploads}"), None
+
+
+class MemorySampler(object):
+    """Track the peak resident memory while a scenario runs."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._task = None
+
+    @staticmethod
+    def current() -> int:
+        """Resident memory in bytes."""
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # peak of the process so far, in kB on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def start(self):
+        self.peak = self.current()
+        self._task = asyncio.ensure_future(self._sample())
+
+    async def stop(self) -> int:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self.peak = max(self.peak, self.current())
+        return self.peak
+
+    async def _sample(self):
+        while True:
+            self.peak = max(self.peak, self.current())
+            await asyncio.sleep(self.interval)
+
+
+def write_fixtures(tmp: str) -> str:
+    """Create scripts, aliases and config in tmp, return the config path."""
+    scripts = os.path.join(tmp, "scripts")
+    os.mkdir(scripts)
+    image = os.path.join(tmp, "bench.png")
+    Image.new("RGB", (1600, 900), (40, 90, 160)).save(image)
+    for name, body in (
+            ("bench.sh", 'echo "result of $*"'),
+            ("image_bench.sh", f'echo "{image}"'),
+    ):
+        path = os.path.join(scripts, name)
+        with open(path, "w") as f:
+            f.write(f"#!/bin/sh\n{body}\n")
+        os.chmod(path, 0o755)
+    aliases = os.path.join(tmp, "aliases.yaml")
+    with open(aliases, "w") as f:
+        yaml.safe_dump({"bench.sh": ["bench"], "image_bench.sh": ["img"]}, f)
+
+    config = {
+        "command_prefix": PREFIX,
+        "script_dir": scripts,
+        "aliases_yaml": aliases,
+        "matrix": {
+            "user_id": BOT_USER,
+            "access_token": "bench",
+            "device_id": "BENCH",
+            "homeserver_url": "https://bench.example",
+            "device_name": "bench",
+            "loop_sleep_time": 1000,
+        },
+        "storage": {
+            "database_filepath": os.path.join(tmp, "bot.db"),
+            "store_filepath": os.path.join(tmp, "store"),
+        },
+        "logging": {
+            "level": "WARNING",
+            "file_logging": {"enabled": False,
+                             "filepath": os.path.join(tmp, "bot.log")},
+            "console_logging": {"enabled": True},
+        },
+    }
+    path = os.path.join(tmp, "config.yaml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+def make_event(n: int, body: str) -> RoomMessageText:
+    return RoomMessageText.from_dict({
+        "event_id": f"$bench{n}",
+        "sender": f"@user{n % 7}:bench.example",
+        "origin_server_ts": int(time.time() * 1000),
+        "type": "m.room.message",
+        "content": {"msgtype": "m.text", "body": body},
+    })
+
+
+async def run_scenario(name: str, config: Config, store: Storage,
+                       args) -> dict:
+    """Feed the events of a scenario and collect the timings."""
+    client = FakeClient(args.latency / 1000)
+    executor = ScriptExecutor(
+        max_concurrent=config.script_max_concurrent,
+        timeout=config.script_timeout,
+        cache=ResultCache(store, maxsize=config.result_cache_size),
+    )
+    dispatcher = Dispatcher()
+    history = CommandHistory(store)
+    callbacks = Callbacks(client, store, config, executor, dispatcher,
+                          history)
+    rooms = [MatrixRoom(f"!room{i}:bench.example", BOT_USER)
+             for i in range(args.rooms)]
+
+    sent_at = {}
+    latencies = []
+    # images carry no number, their replies arrive in order per room
+    pending_images = {room.room_id: [] for room in rooms}
+    done = asyncio.Event()
+
+    def on_send(room_id, content):
+        now = time.monotonic()
+        if content.get("msgtype") == "m.image":
+            numbers = pending_images[room_id][:1]
+            del pending_images[room_id][:1]
+        else:
+            numbers = [int(n) for n in TOKEN_RE.findall(content["body"])]
+        for n in numbers:
+            start = sent_at.pop(n, None)
+            if start is not None:
+                latencies.append(now - start)
+        if len(latencies) == args.events:
+            done.set()
+
+    client.on_send = on_send
+    events = [make_event(n, PREFIX + SCENARIOS[name].format(n=n))
+              for n in range(args.events)]
+
+    memory = MemorySampler()
+    memory.start()
+    history.start()
+    start = time.monotonic()
+    for n, event in enumerate(events):
+        room = rooms[n % len(rooms)]
+        sent_at[n] = time.monotonic()
+        if name == "image":
+            pending_images[room.room_id].append(n)
+        await callbacks.message(room, event)
+    try:
+        await asyncio.wait_for(done.wait(), timeout=args.timeout)
+    except asyncio.TimeoutError:
+        print(f"{name}: only {len(latencies)} of {args.events} replies "
+              f"after {args.timeout}s", file=sys.stderr)
+    elapsed = time.monotonic() - start
+    peak = await memory.stop()
+    await history.stop()
+    await dispatcher.close()
+
+    latencies.sort()
+    return {
+        "events/s": len(latencies) / elapsed,
+        "p50 ms": statistics.median(latencies) * 1000 if latencies else 0,
+        "p99 ms": (latencies[int(len(latencies) * 0.99) - 1] * 1000
+                   if latencies else 0),
+        "peak MB": peak / 2 ** 20,
+        "sends": client.sends,
+        "uploads": client.uploads,
+    }
+
+
+async def main():
+    """Run the scenarios and print one line per scenario."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument("--events", type=int, default=2000,
+                        help="events fed per scenario")
+    parser.add_argument("--rooms", type=int, default=50,
+                        help="rooms the events are spread over")
+    parser.add_argument("--latency", type=float, default=20,
+                        help="simulated latency of every request in ms")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS),
+                        action="append",
+                        help="scenario to run, may be repeated, default all")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the send budget of the outbox instead "
+                        "of lifting it")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="seconds to wait for the replies of a scenario")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = Config(write_fixtures(tmp))
+        if not args.rate_limits:
+            # measure the bot, not the configured send budget
+            outbox.configure(room_rate=0, room_burst=1, account_rate=0,
+                             account_burst=1,
+                             merge_limit=config.send_merge_limit)
+        store = Storage(config.database_filepath)
+        print(f"{args.events} events over {args.rooms} rooms, "
+              f"{args.latency:g}ms simulated latency")
+        print(f"{'scenario':<10} {'events/s':>9} {'p50 ms':>8} {'p99 ms':>8} "
+              f"{'peak MB':>8} {'sends':>6} {'uploads':>7}")
+        for name in args.scenario or SCENARIOS:
+            result = await run_scenario(name, config, store, args)
+            print(f"{name:<10} {result['events/s']:>9.0f} "
+                  f"{result['p50 ms']:>8.1f} {result['p99 ms']:>8.1f} "
+                  f"{result['peak MB']:>8.1f} {result['sends']:>6} "
+                  f"{result['uploads']:>7}")
+        await outbox.close()
+        await store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
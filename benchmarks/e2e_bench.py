@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+r"""e2e_bench.py.
+
+This file implements an end-to-end benchmark of the real bot
+- main.py runs unchanged as a subprocess against the fake homeserver of
+  fake_homeserver.py, so login, key upload, the first sync, joining on
+  invite, the sync loop and the reply path are all the real ones
+- the bot is invited to a number of rooms, then bursts of commands are
+  posted into them; every command carries a number that its reply echoes
+- optionally a share of the sends is answered with M_LIMIT_EXCEEDED and
+  a share of the syncs with a 5xx error
+- it reports the start-up time until the first sync, the time until all
+  invites are joined, replies/s, p50 and p99 of the time from posting a
+  command to its reply arriving at the homeserver, and lost replies
+
+Run it from the repository root:
+    python benchmarks/e2e_bench.py [--rooms N] [--bursts N] [--burst N]
+        [--command "echo #{n}"] [--limit-rate P] [--error-rate P]
+        [--rate-limits]
+
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import yaml  # noqa: E402
+
+from callbacks_bench import PREFIX, write_fixtures  # noqa: E402
+from fake_homeserver import SERVER_NAME, FakeHomeserver  # noqa: E402
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# replies carry the number of their command
+TOKEN_RE = re.compile(r"#(\d+)")
+
+
+def write_config(tmp: str, server: FakeHomeserver, rate_limits: bool) -> str:
+    """Write the bench fixtures, logging in to server with a password."""
+    path = write_fixtures(tmp)
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    config["matrix"] = {
+        "user_id": server.user_id,
+        "user_password": server.password,
+        "device_id": "E2EBENCH",
+        "device_name": "e2e bench",
+        "homeserver_url": server.url,
+        "loop_sleep_time": 10,
+    }
+    config["logging"]["level"] = "WARNING"
+    if not rate_limits:
+        # measure the bot, not the configured send budget
+        config["send"] = {"room_rate": 0, "account_rate": 0}
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+async def wait_for(condition, timeout: float, what: str) -> float:
+    """Poll condition(), return the seconds it took to become true."""
+    start = time.monotonic()
+    while not condition():
+        if time.monotonic() - start > timeout:
+            raise TimeoutError(f"Timed out after {timeout}s waiting for {what}")
+        await asyncio.sleep(0.01)
+    return time.monotonic() - start
+
+
+async def run(args) -> dict:
+    """Start the fake homeserver and the bot, post the bursts, measure."""
+    server = FakeHomeserver(latency=args.latency / 1000)
+    runner = await server.start()
+
+    posted_at = {}
+    latencies = []
+
+    def on_send(room_id, content):
+        now = time.monotonic()
+        for n in TOKEN_RE.findall(content.get("body", "")):
+            start = posted_at.pop(int(n), None)
+            if start is not None:
+                latencies.append(now - start)
+
+    server.on_send = on_send
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = write_config(tmp, server, args.rate_limits)
+        started = time.monotonic()
+        bot = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(REPO, "main.py"), config_path,
+            cwd=REPO,
+            stdout=None if args.verbose else asyncio.subprocess.DEVNULL,
+            stderr=None if args.verbose else asyncio.subprocess.DEVNULL,
+        )
+        try:
+            await asyncio.wait_for(server.first_sync.wait(), args.timeout)
+            startup = time.monotonic() - started
+
+            rooms = [f"!room{i}:{SERVER_NAME}" for i in range(args.rooms)]
+            for room_id in rooms:
+                server.invite(room_id)
+            join_time = await wait_for(
+                lambda: len(server.joined) == len(rooms), args.timeout,
+                "the bot to join all rooms")
+
+            if args.limit_rate:
+                server.fail_randomly("send", args.limit_rate, status=429,
+                                     retry_after_ms=args.retry_after)
+            if args.error_rate:
+                server.fail_randomly("sync", args.error_rate, status=502)
+
+            total = args.bursts * args.burst
+            start = time.monotonic()
+            n = 0
+            for _ in range(args.bursts):
+                by_room = {}
+                for _ in range(args.burst):
+                    body = PREFIX + args.command.format(n=n)
+                    by_room.setdefault(rooms[n % len(rooms)], []).append(body)
+                    posted_at[n] = time.monotonic()
+                    n += 1
+                for room_id, bodies in by_room.items():
+                    server.inject_messages(room_id, bodies)
+                await asyncio.sleep(args.interval / 1000)
+            try:
+                await wait_for(lambda: len(latencies) == total, args.timeout,
+                               "the replies")
+            except TimeoutError as e:
+                print(e, file=sys.stderr)
+            elapsed = time.monotonic() - start
+        finally:
+            if bot.returncode is None:
+                bot.terminate()
+            await bot.wait()
+            await runner.cleanup()
+
+    latencies.sort()
+    return {
+        "startup s": startup,
+        "join s": join_time,
+        "replies/s": len(latencies) / elapsed,
+        "p50 ms": statistics.median(latencies) * 1000 if latencies else 0,
+        "p99 ms": (latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000
+                   if latencies else 0),
+        "lost": total - len(latencies),
+        "sends": len(server.sent),
+        "syncs": server.requests["sync"],
+        "faults": sum(server.faults_served.values()),
+    }
+
+
+def main():
+    """Run the benchmark once and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument("--rooms", type=int, default=20,
+                        help="rooms the bot is invited to")
+    parser.add_argument("--bursts", type=int, default=10,
+                        help="bursts of commands posted")
+    parser.add_argument("--burst", type=int, default=100,
+                        help="commands per burst, spread over the rooms")
+    parser.add_argument("--interval", type=float, default=500,
+                        help="ms between two bursts")
+    parser.add_argument("--command", default="echo #{n}",
+                        help="command posted, #{n} is its number, e.g. "
+                        "'bench #{n}' for the bench script")
+    parser.add_argument("--latency", type=float, default=5,
+                        help="simulated latency of sends and uploads in ms")
+    parser.add_argument("--limit-rate", type=float, default=0,
+                        help="share of sends answered with M_LIMIT_EXCEEDED")
+    parser.add_argument("--retry-after", type=int, default=200,
+                        help="retry_after_ms of those answers")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="share of syncs answered with 502")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the default send budget of the bot "
+                        "instead of lifting it")
+    parser.add_argument("--timeout", type=float, default=120,
+                        help="seconds to wait for each phase")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the output of the bot")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(f"{args.bursts} bursts of {args.burst} commands over {args.rooms} "
+          f"rooms, {args.latency:g}ms simulated latency")
+    for key, value in result.items():
+        if isinstance(value, float):
+            print(f"{key:<10} {value:>10.2f}")
+        else:
+            print(f"{key:<10} {value:>10}")
+
+
+if __name__ == "__main__":
+    main()
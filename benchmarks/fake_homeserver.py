@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+
+r"""fake_homeserver.py.
+
+This file implements a stand-in Matrix homeserver for local load tests
+- just enough of the client-server API for the real main.py to log in,
+  upload its keys, sync, join rooms, upload media and send replies
+- everything is kept in memory, /sync long-polls until new events arrive
+- a test injects bursts of messages and invites, and makes requests fail
+  with M_LIMIT_EXCEEDED or 5xx, either through the Python API of
+  FakeHomeserver or through the /_fake control endpoints
+
+Started as a program, it serves on a local port until interrupted:
+    python benchmarks/fake_homeserver.py [--port 8008]
+    curl -X POST localhost:8008/_fake/invite -d '{"room_id": "!a:fake"}'
+    curl -X POST localhost:8008/_fake/messages \
+        -d '{"room_id": "!a:fake", "bodies": ["!c echo hi"]}'
+    curl -X POST localhost:8008/_fake/fail \
+        -d '{"kind": "send", "count": 3, "status": 429}'
+
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from collections import defaultdict, deque
+from typing import Callable, Dict, List, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SERVER_NAME = "fake.example"
+USER = f"@user:{SERVER_NAME}"
+
+# request kinds faults can be injected into
+FAULT_KINDS = ("sync", "send", "upload", "join", "keys_upload", "login")
+
+
+def _error(status: int, errcode: str, error: str, **extra) -> web.Response:
+    body = {"errcode": errcode, "error": error}
+    body.update(extra)
+    return web.json_response(body, status=status)
+
+
+class FakeHomeserver(object):
+    """In-memory homeserver with a single account, the bot's."""
+
+    def __init__(self, user_id: str = f"@k9:{SERVER_NAME}",
+                 password: str = "fake-password", latency: float = 0):
+        """Initialize.
+
+        Arguments:
+        ---------
+            user_id (str): Matrix user ID of the bot account
+            password (str): password the bot logs in with
+            latency (float): seconds every send, upload and join takes
+
+        """
+        self.user_id = user_id
+        self.password = password
+        self.latency = latency
+        self.access_token = "fake-access-token"
+        self._ids = itertools.count(1)
+        # every event, in the order of the stream; a sync token is the
+        # number of events seen
+        self._log: List[tuple] = []
+        self._state: Dict[str, List[dict]] = defaultdict(list)
+        self._new_events = asyncio.Condition()
+        self.joined = set()
+        self.invited: Dict[str, str] = {}
+        self.filters: Dict[str, dict] = {}
+        # faults to answer the next requests of a kind with
+        self._faults: Dict[str, deque] = defaultdict(deque)
+        # kind -> (probability, status) of random faults
+        self._fault_rates: Dict[str, tuple] = {}
+        # statistics and hooks
+        self.requests: Dict[str, int] = defaultdict(int)
+        self.faults_served: Dict[str, int] = defaultdict(int)
+        self.sync_params: List[dict] = []
+        self.sent: List[tuple] = []
+        self.uploads = 0
+        self.first_sync = asyncio.Event()
+        # called with (room_id, content) for every message the bot sends
+        self.on_send: Optional[Callable[[str, dict], None]] = None
+        # called with the room_id of every room the bot joins
+        self.on_join: Optional[Callable[[str], None]] = None
+
+    # Injection
+
+    def create_room(self, room_id: str, members: int = 3):
+        """Create a room the bot is already joined to."""
+        self._join(room_id, members)
+
+    def invite(self, room_id: str, inviter: str = USER):
+        """Invite the bot to a room, it shows up in the next sync."""
+        self.invited[room_id] = inviter
+        self._append(room_id, self._member_event(self.user_id, "invite",
+                                                 inviter), invite=True)
+
+    def inject_messages(self, room_id: str, bodies: List[str],
+                        sender: str = USER) -> List[str]:
+        """Post text messages to a room, return their event IDs."""
+        if room_id not in self.joined:
+            self.create_room(room_id)
+        event_ids = []
+        for body in bodies:
+            event = self._event(sender, "m.room.message",
+                                {"msgtype": "m.text", "body": body})
+            self._append(room_id, event)
+            event_ids.append(event["event_id"])
+        return event_ids
+
+    def fail(self, kind: str, count: int = 1, status: int = 429,
+             retry_after_ms: int = 100):
+        """Answer the next count requests of a kind with an error.
+
+        Arguments:
+        ---------
+            kind (str): one of FAULT_KINDS
+            count (int): number of requests to fail
+            status (int): 429 for M_LIMIT_EXCEEDED, or e.g. 500, 502, 503
+            retry_after_ms (int): retry_after_ms of a 429 answer
+
+        """
+        for _ in range(count):
+            self._faults[kind].append((status, retry_after_ms))
+
+    def fail_randomly(self, kind: str, probability: float,
+                      status: int = 429, retry_after_ms: int = 100):
+        """Answer a share of the requests of a kind with an error."""
+        self._fault_rates[kind] = (probability, status, retry_after_ms)
+
+    # Internals
+
+    def _event(self, sender: str, event_type: str, content: dict,
+               state_key: Optional[str] = None) -> dict:
+        event = {
+            "event_id": f"$fake{next(self._ids)}:{SERVER_NAME}",
+            "sender": sender,
+            "origin_server_ts": int(time.time() * 1000),
+            "type": event_type,
+            "content": content,
+            "unsigned": {"age": 0},
+        }
+        if state_key is not None:
+            event["state_key"] = state_key
+        return event
+
+    def _member_event(self, user_id: str, membership: str,
+                      sender: Optional[str] = None) -> dict:
+        return self._event(sender or user_id, "m.room.member",
+                           {"membership": membership}, state_key=user_id)
+
+    def _append(self, room_id: str, event: dict, invite: bool = False):
+        self._log.append((room_id, event, invite))
+        if "state_key" in event and not invite:
+            self._state[room_id].append(event)
+
+        async def notify():
+            async with self._new_events:
+                self._new_events.notify_all()
+
+        asyncio.ensure_future(notify())
+
+    def _join(self, room_id: str, members: int = 3):
+        if room_id in self.joined:
+            return
+        self.joined.add(room_id)
+        self.invited.pop(room_id, None)
+        if not self._state[room_id]:
+            self._append(room_id, self._event(
+                USER, "m.room.create", {"creator": USER}, state_key=""))
+            for i in range(members - 1):
+                user = USER if i == 0 else f"@user{i}:{SERVER_NAME}"
+                self._append(room_id, self._member_event(user, "join"))
+        self._append(room_id, self._member_event(self.user_id, "join"))
+
+    def _fault(self, kind: str) -> Optional[web.Response]:
+        self.requests[kind] += 1
+        fault = None
+        if self._faults[kind]:
+            fault = self._faults[kind].popleft()
+        elif kind in self._fault_rates:
+            probability, status, retry_after_ms = self._fault_rates[kind]
+            if random.random() < probability:
+                fault = (status, retry_after_ms)
+        if fault is None:
+            return None
+        self.faults_served[kind] += 1
+        status, retry_after_ms = fault
+        if status == 429:
+            return _error(429, "M_LIMIT_EXCEEDED", "Too many requests",
+                          retry_after_ms=retry_after_ms)
+        return _error(status, "M_UNKNOWN", "Injected server error")
+
+    def _sync_body(self, since: int, full_state: bool) -> dict:
+        join = {}
+        invite = {}
+        for room_id, event, is_invite in self._log[since:]:
+            if is_invite:
+                if room_id in self.invited:
+                    invite[room_id] = {"invite_state": {"events": [
+                        event,
+                        self._event(self.invited[room_id], "m.room.name",
+                                    {"name": room_id}, state_key=""),
+                    ]}}
+                continue
+            if room_id not in self.joined:
+                continue
+            room = join.setdefault(room_id, _joined_room())
+            room["timeline"]["events"].append(event)
+        if full_state or since == 0:
+            for room_id in self.joined:
+                room = join.setdefault(room_id, _joined_room())
+                room["state"]["events"] = list(self._state[room_id])
+        return {
+            "next_batch": str(len(self._log)),
+            "rooms": {"join": join, "invite": invite, "leave": {}},
+            "to_device": {"events": []},
+            "device_lists": {"changed": [], "left": []},
+            "device_one_time_keys_count": {"signed_curve25519": 50},
+            "presence": {"events": []},
+            "account_data": {"events": []},
+        }
+
+    # HTTP handlers
+
+    def _authorized(self, request) -> bool:
+        header = request.headers.get("Authorization", "")
+        token = request.query.get("access_token")
+        return header == f"Bearer {self.access_token}" or (
+            token == self.access_token)
+
+    @web.middleware
+    async def _auth(self, request, handler):
+        path = request.path
+        public = (path.endswith("/login") or path.endswith("/versions")
+                  or path.startswith("/_fake/"))
+        if not public and not self._authorized(request):
+            return _error(401, "M_UNKNOWN_TOKEN", "Unknown access token")
+        return await handler(request)
+
+    async def _versions(self, request):
+        return web.json_response({"versions": ["r0.6.1", "v1.1", "v1.6"]})
+
+    async def _login(self, request):
+        fault = self._fault("login")
+        if fault is not None:
+            return fault
+        body = await request.json()
+        user = body.get("identifier", {}).get("user") or body.get("user")
+        if body.get("password") != self.password or user not in (
+                self.user_id, self.user_id[1:].split(":")[0]):
+            return _error(403, "M_FORBIDDEN", "Invalid password")
+        return web.json_response({
+            "user_id": self.user_id,
+            "access_token": self.access_token,
+            "device_id": body.get("device_id") or "FAKEDEVICE",
+        })
+
+    async def _sync(self, request):
+        fault = self._fault("sync")
+        if fault is not None:
+            return fault
+        since = int(request.query.get("since") or 0)
+        timeout = int(request.query.get("timeout") or 0) / 1000
+        full_state = request.query.get("full_state") == "true"
+        self.sync_params.append(dict(request.query))
+        if since > len(self._log):
+            return _error(400, "M_UNKNOWN", "Invalid stream token")
+        sync_filter = request.query.get("filter")
+        if sync_filter and not sync_filter.startswith("{") and (
+                sync_filter not in self.filters):
+            return _error(400, "M_INVALID_PARAM", "Unknown filter")
+        # an initial sync returns at once, like on a real homeserver
+        initial = "since" not in request.query
+        if not initial and len(self._log) <= since and timeout > 0:
+            async with self._new_events:
+                try:
+                    await asyncio.wait_for(
+                        self._new_events.wait_for(
+                            lambda: len(self._log) > since), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        body = self._sync_body(since, full_state)
+        self.first_sync.set()
+        return web.json_response(body)
+
+    async def _send(self, request):
+        fault = self._fault("send")
+        if fault is not None:
+            return fault
+        await asyncio.sleep(self.latency)
+        room_id = request.match_info["room_id"]
+        if room_id not in self.joined:
+            return _error(403, "M_FORBIDDEN", "Not in room")
+        content = await request.json()
+        event = self._event(self.user_id, request.match_info["event_type"],
+                            content)
+        self._append(room_id, event)
+        self.sent.append((time.monotonic(), room_id, content))
+        if self.on_send is not None:
+            self.on_send(room_id, content)
+        return web.json_response({"event_id": event["event_id"]})
+
+    async def _upload(self, request):
+        fault = self._fault("upload")
+        if fault is not None:
+            return fault
+        await request.read()
+        await asyncio.sleep(self.latency)
+        self.uploads += 1
+        return web.json_response(
+            {"content_uri": f"mxc://{SERVER_NAME}/upload{self.uploads}"})
+
+    async def _join_room(self, request):
+        fault = self._fault("join")
+        if fault is not None:
+            return fault
+        await asyncio.sleep(self.latency)
+        room_id = request.match_info["room_id"]
+        self._join(room_id)
+        if self.on_join is not None:
+            self.on_join(room_id)
+        return web.json_response({"room_id": room_id})
+
+    async def _keys_upload(self, request):
+        fault = self._fault("keys_upload")
+        if fault is not None:
+            return fault
+        await request.read()
+        return web.json_response(
+            {"one_time_key_counts": {"signed_curve25519": 50}})
+
+    async def _keys_query(self, request):
+        return web.json_response({"device_keys": {}, "failures": {}})
+
+    async def _create_filter(self, request):
+        filter_id = str(len(self.filters) + 1)
+        self.filters[filter_id] = await request.json()
+        return web.json_response({"filter_id": filter_id})
+
+    async def _empty(self, request):
+        await request.read()
+        return web.json_response({})
+
+    # Control endpoints
+
+    async def _control_invite(self, request):
+        body = await request.json()
+        self.invite(body["room_id"], body.get("inviter", USER))
+        return web.json_response({})
+
+    async def _control_messages(self, request):
+        body = await request.json()
+        event_ids = self.inject_messages(
+            body["room_id"], body["bodies"], body.get("sender", USER))
+        return web.json_response({"event_ids": event_ids})
+
+    async def _control_fail(self, request):
+        body = await request.json()
+        if "probability" in body:
+            self.fail_randomly(body["kind"], body["probability"],
+                               body.get("status", 429),
+                               body.get("retry_after_ms", 100))
+        else:
+            self.fail(body["kind"], body.get("count", 1),
+                      body.get("status", 429),
+                      body.get("retry_after_ms", 100))
+        return web.json_response({})
+
+    async def _control_stats(self, request):
+        return web.json_response({
+            "requests": self.requests,
+            "faults": self.faults_served,
+            "sent": len(self.sent),
+            "uploads": self.uploads,
+            "joined": sorted(self.joined),
+        })
+
+    def app(self) -> web.Application:
+        """Return the aiohttp application serving the API."""
+        app = web.Application(middlewares=[self._auth],
+                              client_max_size=100 * 2 ** 20)
+        client = "/_matrix/client/{version:(r0|v3)}"
+        media = "/_matrix/media/{version:(r0|v3)}"
+        app.router.add_get("/_matrix/client/versions", self._versions)
+        app.router.add_post(client + "/login", self._login)
+        app.router.add_get(client + "/sync", self._sync)
+        app.router.add_put(
+            client + "/rooms/{room_id}/send/{event_type}/{txn_id}",
+            self._send)
+        app.router.add_post(media + "/upload", self._upload)
+        app.router.add_post(client + "/join/{room_id}", self._join_room)
+        app.router.add_post(client + "/rooms/{room_id}/join",
+                            self._join_room)
+        app.router.add_post(client + "/keys/upload", self._keys_upload)
+        app.router.add_post(client + "/keys/query", self._keys_query)
+        app.router.add_post(client + "/user/{user_id}/filter",
+                            self._create_filter)
+        app.router.add_put(client + "/devices/{device_id}", self._empty)
+        app.router.add_put(client + "/rooms/{room_id}/typing/{user_id}",
+                           self._empty)
+        app.router.add_post(
+            client + "/rooms/{room_id}/receipt/{type}/{event_id}",
+            self._empty)
+        app.router.add_post("/_fake/invite", self._control_invite)
+        app.router.add_post("/_fake/messages", self._control_messages)
+        app.router.add_post("/_fake/fail", self._control_fail)
+        app.router.add_get("/_fake/stats", self._control_stats)
+        return app
+
+    async def start(self, host: str = "127.0.0.1",
+                    port: int = 0) -> web.AppRunner:
+        """Serve on host:port, port 0 picks a free one.
+
+        Returns the runner; self.url is the homeserver URL to use.
+        """
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        logger.info(f"Fake homeserver listening on {self.url}")
+        return runner
+
+
+def _joined_room() -> dict:
+    return {
+        "timeline": {"events": [], "limited": False, "prev_batch": "0"},
+        "state": {"events": []},
+        "ephemeral": {"events": []},
+        "account_data": {"events": []},
+        "summary": {},
+        "unread_notifications": {},
+    }
+
+
+async def _serve(args):
+    server = FakeHomeserver(args.user_id, args.password,
+                            latency=args.latency / 1000)
+    await server.start(args.host, args.port)
+    print(f"Serving {server.url} for {args.user_id}, password "
+          f"{args.password!r}")
+    await asyncio.Event().wait()
+
+
+def main():
+    """Serve a fake homeserver until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--user-id", default=f"@k9:{SERVER_NAME}")
+    parser.add_argument("--password", default="fake-password")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="ms every send, upload and join takes")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+r"""markdown_bench.py.
+
+This file implements a benchmark of the Markdown rendering of messages
+- compares markdown.markdown(), called per message as chat_functions did
+  before, with the shared MarkdownRenderer
+- uses a mix of the bot's typical replies: echo-like plain text, the
+  static help and info replies and a Markdown formatted script output
+
+Run it from the repository root:
+    python benchmarks/markdown_bench.py [--number N]
+
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from markdown import markdown  # noqa: E402
+
+from markdown_renderer import MarkdownRenderer  # noqa: E402
+
+MESSAGES = {
+    "plain": "Hello, world!",
+    "plain paragraphs": "Wien: 21 degrees, sunny\n\nTomorrow: 18 degrees, rain",
+    "help": "Ahoi, I'm K9!\nUse `commands` to view available commands.",
+    "info": ("Find my source and additional info under: "
+             "https://github.com/0x01DA/k9-bot"),
+    "script output": "\n".join(
+        f"* **{i}.** [Story number {i}](https://example.com/{i}) "
+        f"({i * 7} points, `{i * 3}` comments)" for i in range(30)),
+}
+
+
+def per_call_us(func, number: int) -> float:
+    """Return the mean time of one call in microseconds, best of three."""
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+
+def main():
+    """Print the per-message cost before and after."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument("--number", type=int, default=500,
+                        help="messages rendered per measurement")
+    args = parser.parse_args()
+
+    renderer = MarkdownRenderer()
+    print(f"{'message':<18} {'before (us)':>12} {'after (us)':>12} "
+          f"{'speed-up':>9}")
+    for name, text in MESSAGES.items():
+        assert renderer.render(text) == markdown(text), name
+        before = per_call_us(lambda: markdown(text), args.number)
+        after = per_call_us(lambda: renderer.render(text), args.number)
+        print(f"{name:<18} {before:>12.1f} {after:>12.2f} "
+              f"{before / after:>8.0f}x")
+
+    # a message that is never repeated misses the cache every time
+    counter = iter(range(10 ** 9))
+    text = MESSAGES["script output"]
+    uncached = MarkdownRenderer(cache_size=1)
+    before = per_call_us(lambda: markdown(f"{next(counter)} {text}"),
+                         args.number // 10)
+    after = per_call_us(lambda: uncached.render(f"{next(counter)} {text}"),
+                        args.number // 10)
+    print(f"{'uncached output':<18} {before:>12.1f} {after:>12.2f} "
+          f"{before / after:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
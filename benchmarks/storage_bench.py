@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+r"""storage_bench.py.
+
+This file implements a benchmark of Storage writes under command load
+- many concurrent "commands" each store a script result and read it back,
+  like the result cache does
+- before: a plain sqlite3 connection in rollback journal mode that
+  commits every write on the event loop thread, as Storage used to
+- after: Storage, with WAL, its own DB thread and batched commits
+- reports writes per second and the longest stall of the event loop,
+  i.e. how long a sync or a reply in another room would have waited
+
+Run it from the repository root:
+    python benchmarks/storage_bench.py [--commands N] [--seconds S]
+
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import Storage  # noqa: E402
+
+
+class BlockingStorage(object):
+    """The former Storage: synchronous calls and a commit per write."""
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("CREATE TABLE command_cache ("
+                          "key TEXT PRIMARY KEY, expires REAL NOT NULL, "
+                          "stdout TEXT NOT NULL, stderr TEXT NOT NULL)")
+        self.conn.commit()
+
+    async def put_cached_result(self, key, expires, stdout, stderr):
+        self.conn.execute("INSERT OR REPLACE INTO command_cache "
+                          "(key, expires, stdout, stderr) VALUES (?, ?, ?, ?)",
+                          (key, expires, stdout, stderr))
+        self.conn.commit()
+
+    async def get_cached_result(self, key):
+        return self.conn.execute("SELECT expires, stdout, stderr FROM "
+                                 "command_cache WHERE key = ?",
+                                 (key,)).fetchone()
+
+    async def close(self):
+        self.conn.close()
+
+
+async def load(store, commands: int, seconds: float):
+    """Return (writes per second, longest event loop stall in ms)."""
+    writes = 0
+    stall = 0.0
+    deadline = time.monotonic() + seconds
+    output = "x" * 2000
+
+    async def command(n):
+        nonlocal writes
+        i = 0
+        while time.monotonic() < deadline:
+            key = f"{n}-{i % 50}"
+            await store.put_cached_result(key, time.time() + 60, output, "")
+            await store.get_cached_result(key)
+            writes += 1
+            i += 1
+            # let other coroutines run, as a real command would
+            await asyncio.sleep(0)
+
+    async def ticker():
+        nonlocal stall
+        while time.monotonic() < deadline:
+            before = time.monotonic()
+            await asyncio.sleep(0.001)
+            stall = max(stall, time.monotonic() - before - 0.001)
+
+    start = time.monotonic()
+    await asyncio.gather(ticker(), *(command(n) for n in range(commands)))
+    elapsed = time.monotonic() - start
+    await store.close()
+    return writes / elapsed, stall * 1000
+
+
+async def main():
+    """Print writes per second before and after."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument("--commands", type=int, default=32,
+                        help="concurrent commands writing results")
+    parser.add_argument("--seconds", type=float, default=3,
+                        help="duration of each run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {
+            "before": await load(
+                BlockingStorage(os.path.join(tmp, "before.db")),
+                args.commands, args.seconds),
+            "after": await load(
+                Storage(os.path.join(tmp, "after.db")),
+                args.commands, args.seconds),
+        }
+    print(f"{args.commands} concurrent commands, {args.seconds}s each")
+    print(f"{'':<8} {'writes/s':>10} {'max loop stall (ms)':>20}")
+    for name, (rate, stall) in results.items():
+        print(f"{name:<8} {rate:>10.0f} {stall:>20.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,21 +2,32 @@
 
 import logging
 import os
-import json
 import re
-import subprocess
+import time
 import traceback
-from chat_functions import send_text_to_room, send_image_to_room
+from chat_functions import (
+    send_text_to_room,
+    send_image_to_room,
+    send_output_to_room,
+    send_next_page,
+    StreamingReply,
+)
+from command_index import BUILTIN
+from metrics import COMMANDS
 
 logger = logging.getLogger(__name__)
 
 SERVER_ERROR_MSG = "Bot encountered an error. Here is the stack trace: \n"
 
+# splits arguments on whitespace and commas, keeping "quoted strings" intact
+ARGS_RE = re.compile(r'(?:[^\s,"]|"(?:\\.|[^"])*")+')
+
 
 class Command(object):
     """Use this class for your bot commands."""
 
-    def __init__(self, client, store, config, command, room, event):
+    def __init__(self, client, store, config, command, room, event, executor,
+                 history=None):
         """Set up bot commands."""
         self.client = client
         self.store = store
@@ -24,38 +35,83 @@ class Command(object):
         self.command = command
         self.room = room
         self.event = event
-        # self.args: list : list of arguments
-        self.args = re.findall(r'(?:[^\s,"]|"(?:\\.|[^"])*")+', self.command)[1:]
-        self.aliases = self.config.aliases
+        # self.executor: ScriptExecutor : shared runner for script commands
+        self.executor = executor
+        # self.history: CommandHistory : where the finished command is
+        # recorded, None to not record it
+        self.history = history
+        self.received = time.time()
+        self._received_monotonic = time.monotonic()
+        # filled in while the command is processed, for the history
+        self.exit_code = None
+        self.output_bytes = None
+        # self.commands: CommandIndex : alias table at the time the command
+        # arrived
+        self.commands = self.config.commands
+        self.aliases = self.commands.aliases
         self.scripts_dir = self.config.scripts_path_abs
-        self.commandlower = self.command.lower().split()[0]
+        head, *rest = self.command.split(None, 1)
+        self.commandlower = head.lower()
+        self._rest = rest[0] if rest else ""
+        self._args = None
+        # self.entry: CommandEntry : handler of the command, None if unknown
+        self.entry = self.commands.get(self.commandlower)
+
+    @property
+    def args(self):
+        """list: arguments of the command, tokenised on first use."""
+        if self._args is None:
+            self._args = ARGS_RE.findall(self._rest)
+        return self._args
 
+    @property
+    def is_builtin(self):
+        """Whether the command is answered by the bot without a script."""
+        return self.entry is not None and self.entry.kind == BUILTIN
 
     async def process(self):  # noqa
         """Process the command."""
 
         logger.info(f"bot_commands :: Command.process: {self.command} {self.room.display_name} via {self.event}")
-        # echo
-        if re.match("^echo$|^echo .*", self.commandlower):
-            await self._echo()
-        # help
-        elif re.match("^help$|^man$|^hilfe$|^help.sh$", self.commandlower):
-            await self._show_help()
-        elif re.match("^info$|^source$", self.commandlower):
-            await self._show_info()
-        elif re.match("^list$|^commands$|^ls$", self.commandlower):
-            await self._list_commands()
-        else:
-            for command, alias in self.aliases.items():
-              if self.commandlower in alias:
-                await self._os_cmd(
-                  cmd=command,
-                  args=self.args,
-                  markdown_convert=False,
-                  formatted=True,
-                  code=False,
+        if self.entry is None:
+            return
+        COMMANDS.inc(self.commandlower)
+        started = time.monotonic()
+        try:
+            await self._dispatch()
+        finally:
+            if self.history is not None:
+                self.history.record(
+                    self.received,
+                    self.commandlower,
+                    self.entry.target,
+                    self.room.room_id,
+                    self.event.sender,
+                    queue_wait=started - self._received_monotonic,
+                    run_time=time.monotonic() - started,
+                    exit_code=self.exit_code,
+                    output_bytes=self.output_bytes,
                 )
 
+    async def _dispatch(self):
+        """Run the builtin or script the command maps to."""
+        if self.entry.kind == BUILTIN:
+            await getattr(self, self.entry.target)()
+            self.exit_code = 0
+        else:
+            await self._os_cmd(
+              cmd=self.entry.target,
+              args=self.args,
+              markdown_convert=False,
+              formatted=True,
+              code=False,
+              split=self.entry.options.get("split"),
+              cache_ttl=self.entry.options.get("cache_ttl", 0),
+              coalesce=self.entry.options.get("coalesce", False),
+              pooled=self.entry.options.get("pool", True),
+              stream=self.entry.options.get("stream", False),
+            )
+
     async def _echo(self):
         """Echo back the command's arguments."""
         response = " ".join(self.args)
@@ -77,11 +133,16 @@ class Command(object):
 
     async def _list_commands(self):
         """List Commands.."""
-        aliases = json.dumps(self.aliases, sort_keys=True, indent=4)
-        response = (aliases)
+        response = self.commands.listing
         await send_text_to_room(self.client, self.room.room_id, response, code=True)
         return
 
+    async def _more(self):
+        """Send the next page of the last long output in this room."""
+        if not await send_next_page(self.client, self.room.room_id):
+            await send_text_to_room(
+                self.client, self.room.room_id, "Nothing more to show.")
+
     async def _unknown_command(self):
         await send_text_to_room(
             self.client,
@@ -96,6 +157,10 @@ class Command(object):
         formatted=True,
         code=False,
         split=None,
+        cache_ttl=0,
+        coalesce=False,
+        pooled=True,
+        stream=False,
     ):
         """Pass generic command on to the operating system.
 
@@ -105,6 +170,14 @@ class Command(object):
         markdown_convert (bool): value for how to format response
         formatted (bool): value for how to format response
         code (bool): value for how to format response
+        cache_ttl (float): seconds the output may be reused for the same
+            arguments, 0 to always run the command
+        coalesce (bool): whether to share the output of an identical
+            command that is already running, e.g. in another room
+        pooled (bool): whether a Python script may run in a warm worker
+            instead of a subprocess of its own
+        stream (bool): whether to post the output while the command is
+            still running, by editing the reply as output arrives
         """
         try:
             # create a combined argv list, e.g. ['date', '--utc']
@@ -113,19 +186,32 @@ class Command(object):
             envirnoment = os.environ.copy()
             envirnoment["PATH"] = "{}:{}".format(self.scripts_dir, envirnoment["PATH"])
             envirnoment["K9_ROOM"] = self.room.display_name
-            run = subprocess.Popen(
-                argv_list,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-                env=envirnoment,
-            )
-            output, std_err = run.communicate()
-            output = output.strip()
-            std_err = std_err.strip()
-            if run.returncode != 0:
+            envirnoment["K9_SCRIPT"] = cmd
+            if stream and not cmd.startswith('image_'):
+                await self._stream_os_cmd(
+                    argv_list, envirnoment,
+                    markdown_convert=markdown_convert,
+                    formatted=formatted,
+                    code=code,
+                    split=split,
+                )
+                return
+            result = await self.executor.run(
+                argv_list, envirnoment, cache_ttl=cache_ttl,
+                coalesce=coalesce, pooled=pooled)
+            self.exit_code = result.returncode
+            self.output_bytes = len(result.stdout.encode())
+            output = result.stdout.strip()
+            std_err = result.stderr.strip()
+            if result.timed_out:
                 output = (
-                    f"command {cmd} returned an error: {run.returncode}\n"
+                    f"command {cmd} timed out after {self.executor.timeout}s\n"
+                    f"STDERR:\n{std_err}\nSTDOUT:\n{output}"
+                )
+                logger.debug(output)
+            elif result.returncode != 0:
+                output = (
+                    f"command {cmd} returned an error: {result.returncode}\n"
                     f"STDERR:\n{std_err}\nSTDOUT:\n{output}"
                 )
                 logger.debug(output)
@@ -142,18 +228,57 @@ class Command(object):
             await send_image_to_room(
               self.client,
               self.room.room_id,
-              response
+              response,
+              store=self.store,
             )
             return
 
         logger.debug(f"Sending this reply back: {response}")
-        await send_text_to_room(
+        await send_output_to_room(
             self.client,
             self.room.room_id,
             response,
+            inline_limit=self.config.output_inline_limit,
+            page_size=self.config.output_page_size,
+            file_limit=self.config.output_file_limit,
+            more_command=f"{self.config.command_prefix}more",
+            filename=f"{os.path.splitext(cmd)[0]}.txt",
+            store=self.store,
             markdown_convert=markdown_convert,
             formatted=formatted,
             code=code,
             split=split,
         )
 
+    async def _stream_os_cmd(self, argv_list, envirnoment, split=None,
+                             **kwargs):
+        """Run a command and post its output while it arrives."""
+        reply = StreamingReply(
+            self.client,
+            self.room.room_id,
+            interval=self.config.stream_edit_interval,
+            split=split,
+            max_size=self.config.output_page_size,
+            **kwargs,
+        )
+        try:
+            result = await self.executor.stream(
+                argv_list, envirnoment, reply.feed)
+        except BaseException:
+            reply.cancel()
+            raise
+        self.exit_code = result.returncode
+        self.output_bytes = len(result.stdout.encode())
+        trailer = ""
+        std_err = result.stderr.strip()
+        if result.timed_out:
+            trailer = (
+                f"\ncommand {argv_list[0]} timed out after "
+                f"{self.executor.timeout}s\nSTDERR:\n{std_err}"
+            )
+        elif result.returncode != 0:
+            trailer = (
+                f"\ncommand {argv_list[0]} returned an error: "
+                f"{result.returncode}\nSTDERR:\n{std_err}"
+            )
+        await reply.close(trailer)
@@ -33,7 +33,8 @@ logger = logging.getLogger(__name__)
 class Callbacks(object):
     """Collection of all callbacks."""
 
-    def __init__(self, client, store, config):
+    def __init__(self, client, store, config, executor, dispatcher,
+                 history=None):
         """Initialize.
 
         Arguments:
@@ -41,16 +42,26 @@ class Callbacks(object):
             client (nio.AsyncClient): nio client used to interact with matrix
             store (Storage): Bot storage
             config (Config): Bot configuration parameters
+            executor (ScriptExecutor): Runner for script commands
+            dispatcher (Dispatcher): Queues handlers per room
+            history (CommandHistory): Records the processed commands,
+                None to not record them
 
         """
         self.client = client
         self.store = store
         self.config = config
+        self.executor = executor
+        self.dispatcher = dispatcher
+        self.history = history
         self.command_prefix = config.command_prefix
 
     async def message(self, room, event):
         """Handle an incoming message event.
 
+        The message is only queued on the dispatcher, so a slow command
+        does not hold up later events of the same sync batch.
+
         Arguments:
         ---------
             room (nio.rooms.MatrixRoom): The room the event came from
@@ -79,7 +90,8 @@ class Callbacks(object):
             # General message listener
             message = Message(self.client, self.store,
                               self.config, msg, room, event)
-            await message.process()
+            self.dispatcher.submit(room.room_id, message.process,
+                                   priority=True)
             return
 
         # Otherwise if this is in a 1-1 with the bot or features a command
@@ -88,9 +100,14 @@ class Callbacks(object):
             # Remove the command prefix
             msg = msg[len(self.command_prefix):]
 
+        if not msg.strip():
+            return
+
         command = Command(self.client, self.store,
-                          self.config, msg, room, event)
-        await command.process()
+                          self.config, msg, room, event, self.executor,
+                          self.history)
+        self.dispatcher.submit(room.room_id, command.process,
+                               priority=command.is_builtin)
 
     async def invite(self, room, event):
         """Handle an incoming invite event.
@@ -3,8 +3,14 @@
 r"""chat_functions.py.
 
 This file implements utility functions for
-- sending text messages
-- sending images
+- sending text messages, to one room or to many rooms at once
+- queueing everything sent within the rate limits of the homeserver,
+  see outbox.py
+- editing text messages, e.g. to stream the output of a command
+- sending command output of any size: inline, as pages to fetch with
+  `more`, or as a text file
+- sending images, with a thumbnail for large ones
+- uploading media only once, remembering the mxc:// URI of its content
 - sending of other files like audio, video, text, PDFs, .doc, etc.
 
 Don't change tabbing, spacing, or formating as the
@@ -12,18 +18,31 @@ file is automatically linted and beautified.
 
 """
 
+import asyncio
 import logging
 import os
+import shutil
+import tempfile
+import time
 import traceback
+from collections import deque
 
-import aiofiles.os
-import magic
-from markdown import markdown
-from nio import SendRetryError, UploadResponse
-from PIL import Image
+import aiofiles
+from nio import RoomSendResponse, SendRetryError, UploadResponse
+
+from markdown_renderer import renderer
+from media import inspect_media, make_thumbnail
+from metrics import REQUEST_SECONDS
+from outbox import Outbox
 
 logger = logging.getLogger(__name__)
 
+# number of rooms a message is sent to at the same time
+FAN_OUT_LIMIT = 8
+
+# every room message is sent through this queue, main.py configures it
+outbox = Outbox()
+
 
 async def send_text_to_room(
     client,
@@ -34,6 +53,7 @@ async def send_text_to_room(
     formatted=True,
     code=False,
     split=None,
+    mergeable=False,
 ):
     """Send text to a matrix room.
 
@@ -63,6 +83,13 @@ async def send_text_to_room(
         the string specified in split occurs
         Defaults to None
 
+    mergeable (bool): whether the parts of a split message may be merged
+        with each other while they wait in the outbox, never with other
+        messages. Only for consecutive parts of the same output.
+        Defaults to False
+
+    Returns the response of the last room_send(), None if it failed.
+
     """
     logger.debug(f"send_text_to_room {room_id} {message}")
     messages = []
@@ -75,32 +102,404 @@ async def send_text_to_room(
     else:
         messages.append(message)
 
-    for message in messages:
-        # Determine whether to ping room members or not
-        msgtype = "m.notice" if notice else "m.text"
+    contents = [
+        _text_content(message, notice, markdown_convert, formatted, code)
+        for message in messages
+    ]
+    pending = None
+    if mergeable and len(contents) > 1:
+        # queued together, so parts waiting for the budget can be merged
+        pending = outbox.send_parts(
+            client, room_id, "m.room.message", contents,
+            ignore_unverified_devices=True,
+        )
 
-        content = {
-            "msgtype": msgtype,
-            "body": message,
-        }
+    response = None
+    for i, content in enumerate(contents):
+        try:
+            if pending is not None:
+                response = await pending[i]
+            else:
+                response = await outbox.send(
+                    client,
+                    room_id,
+                    "m.room.message",
+                    content,
+                    ignore_unverified_devices=True,
+                )
+        except SendRetryError:
+            logger.exception(f"Unable to send message response to {room_id}")
+            response = None
+    return response
+
+
+async def send_text_to_rooms(client, rooms, message, limit=FAN_OUT_LIMIT, **kwargs):
+    """Send text to multiple matrix rooms concurrently.
+
+    Arguments:
+    ---------
+    client (nio.AsyncClient): The client to communicate with Matrix
+    rooms (list): list of room_id-s
+    message (str): The message content
+    limit (int): number of rooms sent to at the same time
+    kwargs: notice, markdown_convert, formatted, code and split as
+        for send_text_to_room()
+
+    Returns a dict room_id -> error for the rooms the message could not be
+    sent to, empty if all went well.
+
+    """
+
+    async def send_one(room_id):
+        response = await send_text_to_room(client, room_id, message, **kwargs)
+        if not isinstance(response, RoomSendResponse):
+            raise RuntimeError(f"send failed: {response}")
+
+    return await _fan_out(rooms, send_one, limit)
+
+
+async def _fan_out(rooms, send_one, limit=FAN_OUT_LIMIT):
+    """Run send_one(room_id) for all rooms, at most limit at a time.
+
+    A failure in one room does not stop the others.
+
+    Arguments:
+    ---------
+    rooms (list): list of room_id-s
+    send_one (coroutine function): sends to a single room, raises on
+        failure
+    limit (int): number of rooms sent to at the same time
+
+    Returns a dict room_id -> exception of the failed rooms.
+
+    """
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def guarded(room_id):
+        async with semaphore:
+            await send_one(room_id)
+
+    rooms = list(dict.fromkeys(rooms))
+    results = await asyncio.gather(
+        *(guarded(room_id) for room_id in rooms), return_exceptions=True
+    )
+    failures = {}
+    for room_id, result in zip(rooms, results):
+        if isinstance(result, asyncio.CancelledError):
+            raise result
+        if isinstance(result, BaseException):
+            logger.warning(f"Sending to room {room_id} failed: {result}")
+            failures[room_id] = result
+    return failures
 
-        if formatted:
-            content["format"] = "org.matrix.custom.html"
 
-        if code:
-            content["formatted_body"] = "<pre><code>" + message + "</code></pre>"
-        elif markdown_convert:
-            content["formatted_body"] = markdown(message)
+def _all_failed(rooms, reason):
+    """Return the failures of a message that could not be sent anywhere."""
+    return {room_id: RuntimeError(reason) for room_id in rooms}
+
+
+async def _send_content(client, room_id, content):
+    """Send a message event with the given content, raise if it fails."""
+    response = await outbox.send(client, room_id, "m.room.message", content)
+    if not isinstance(response, RoomSendResponse):
+        raise RuntimeError(f"send failed: {response}")
+    return response
+
+
+def _text_content(message, notice, markdown_convert, formatted, code):
+    """Build the content of a text message event."""
+    # Determine whether to ping room members or not
+    msgtype = "m.notice" if notice else "m.text"
+
+    content = {
+        "msgtype": msgtype,
+        "body": message,
+    }
+
+    if formatted:
+        content["format"] = "org.matrix.custom.html"
+
+    if code:
+        content["formatted_body"] = "<pre><code>" + message + "</code></pre>"
+    elif markdown_convert:
+        content["formatted_body"] = renderer.render(message)
+    return content
+
+
+async def edit_text_in_room(
+    client,
+    room_id,
+    event_id,
+    message,
+    notice=True,
+    markdown_convert=True,
+    formatted=True,
+    code=False,
+):
+    """Replace the text of a message sent before (a Matrix edit).
+
+    Arguments:
+    ---------
+    client (nio.AsyncClient): The client to communicate with Matrix
+
+    room_id (str): The ID of the room the message was sent to
+
+    event_id (str): The ID of the message event to replace
+
+    message (str): The new message content
+
+    The remaining arguments are the same as for send_text_to_room().
+
+    """
+    new_content = _text_content(message, notice, markdown_convert, formatted, code)
+    content = dict(new_content)
+    # clients without support for edits show the fallback body
+    content["body"] = "* " + message
+    if "formatted_body" in content:
+        content["formatted_body"] = "* " + content["formatted_body"]
+    content["m.new_content"] = new_content
+    content["m.relates_to"] = {"rel_type": "m.replace", "event_id": event_id}
+
+    try:
+        return await outbox.send(
+            client, room_id, "m.room.message", content, ignore_unverified_devices=True,
+        )
+    except SendRetryError:
+        logger.exception(f"Unable to edit message {event_id} in {room_id}")
+
+
+class StreamingReply(object):
+    """Text reply that grows while the output of a command arrives.
+
+    The first output is posted as a new message right away, later output
+    is added by editing that message, at most once per interval. Output
+    that arrives within the interval is posted when it ends, even if the
+    command stays silent then. If split is given, each complete part
+    becomes a message of its own, like send_text_to_room() would send it.
+    """
 
+    def __init__(self, client, room_id, interval=2.0, split=None,
+                 max_size=8000, **kwargs):
+        """Initialize.
+
+        Arguments:
+        ---------
+        client (nio.AsyncClient): The client to communicate with Matrix
+        room_id (str): The ID of the room to send the message to
+        interval (float): minimum seconds between two edits of a message
+        split (str): separator between parts that go into own messages
+        max_size (int): characters after which a message is finished and
+            the output continues in a new one
+        kwargs: formatting arguments for send_text_to_room()
+
+        """
+        self.client = client
+        self.room_id = room_id
+        self.interval = interval
+        self.split = split
+        self.max_size = max_size
+        self.kwargs = kwargs
+        self._buffer = ""
+        self._sent = ""
+        self._event_id = None
+        self._last_flush = 0.0
+        # feed() and the deferred flush must not send at the same time
+        self._lock = asyncio.Lock()
+        self._deferred = None
+
+    async def feed(self, text):
+        """Add output and post it if the interval has passed."""
+        async with self._lock:
+            self._buffer += text
+            if self.split:
+                while self.split in self._buffer:
+                    part, self._buffer = self._buffer.split(self.split, 1)
+                    await self._finish(part)
+            while len(self._buffer) > self.max_size:
+                part, self._buffer = _cut(self._buffer, self.max_size)
+                await self._finish(part)
+            wait = self._last_flush + self.interval - time.monotonic()
+            if wait <= 0:
+                await self._flush(self._buffer)
+            elif self._deferred is None:
+                self._deferred = asyncio.ensure_future(
+                    self._flush_later(wait))
+
+    async def close(self, trailer=""):
+        """Post everything that is left, plus an optional trailer."""
+        self.cancel()
+        async with self._lock:
+            await self._flush(self._buffer + trailer)
+
+    def cancel(self):
+        """Drop a pending deferred post, e.g. when the command failed."""
+        if self._deferred is not None:
+            self._deferred.cancel()
+            self._deferred = None
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        # from here on it is no longer cancelled, close() waits for it
+        self._deferred = None
+        async with self._lock:
+            await self._flush(self._buffer)
+
+    async def _finish(self, message):
+        await self._flush(message)
+        self._event_id = None
+        self._sent = ""
+
+    async def _flush(self, message):
+        message = message.strip()
+        if message == "" or message == self._sent:
+            return
+        self._last_flush = time.monotonic()
+        if self._event_id is None:
+            response = await send_text_to_room(
+                self.client, self.room_id, message, **self.kwargs)
+            self._event_id = getattr(response, "event_id", None)
+        else:
+            await edit_text_in_room(
+                self.client, self.room_id, self._event_id, message,
+                **self.kwargs)
+        self._sent = message
+
+
+def _cut(text, size):
+    """Split text after at most size characters, at a newline if possible."""
+    cut = text.rfind("\n", 0, size + 1)
+    if cut <= 0:
+        return text[:size], text[size:]
+    return text[:cut], text[cut + 1:]
+
+
+def _paginate(text, size):
+    """Split text into pages of at most size characters."""
+    pages = []
+    while len(text) > size:
+        page, text = _cut(text, size)
+        pages.append(page)
+    pages.append(text)
+    return pages
+
+
+class Pager(object):
+    """Pages of long outputs, kept per room until fetched with `more`."""
+
+    def __init__(self, ttl=900):
+        """Initialize.
+
+        Arguments:
+        ---------
+        ttl (float): seconds after which unfetched pages are dropped
+
+        """
+        self.ttl = ttl
+        # room_id -> (expiry, deque of pages, formatting arguments)
+        self._rooms = {}
+
+    def put(self, room_id, pages, kwargs):
+        """Keep pages for a room, replacing older ones."""
+        self._rooms[room_id] = (time.monotonic() + self.ttl, deque(pages), kwargs)
+
+    def pop(self, room_id):
+        """Return (page, pages left, formatting arguments) or None."""
+        now = time.monotonic()
+        for expired in [r for r, v in self._rooms.items() if v[0] < now]:
+            del self._rooms[expired]
+        if room_id not in self._rooms:
+            return None
+        _, pages, kwargs = self._rooms[room_id]
+        page = pages.popleft()
+        if not pages:
+            del self._rooms[room_id]
+        return page, len(pages), kwargs
+
+
+pager = Pager()
+
+
+async def send_output_to_room(
+    client,
+    room_id,
+    message,
+    inline_limit=8000,
+    page_size=8000,
+    file_limit=65536,
+    more_command="more",
+    filename="output.txt",
+    store=None,
+    **kwargs,
+):
+    """Send command output of any size to a matrix room.
+
+    Output up to inline_limit characters is sent as is. Longer output up
+    to file_limit characters is cut into pages: the first one is sent, the
+    others are kept in the pager until someone asks for them with
+    more_command. Anything longer is uploaded once as a text file.
+
+    Arguments:
+    ---------
+    client (nio.AsyncClient): The client to communicate with Matrix
+    room_id (str): The ID of the room to send the message to
+    message (str): The message content
+    inline_limit (int): characters that are sent as a single message
+    page_size (int): characters per page
+    file_limit (int): characters up to which output is paginated
+    more_command (str): command that fetches the next page, for the hint
+    filename (str): name of the text file for very long output
+    store (Storage): Bot storage to look up earlier uploads in
+    kwargs: formatting arguments for send_text_to_room()
+
+    """
+    if len(message) <= inline_limit:
+        # the parts of a split output may go out as one event
+        return await send_text_to_room(
+            client, room_id, message, mergeable=bool(kwargs.get("split")),
+            **kwargs)
+
+    if len(message) > file_limit:
+        tmp_dir = tempfile.mkdtemp(prefix="k9-")
+        path = os.path.join(tmp_dir, filename)
         try:
-            await client.room_send(
-                room_id, "m.room.message", content, ignore_unverified_devices=True,
-            )
-        except SendRetryError:
-            logger.exception(f"Unable to send message response to {room_id}")
+            async with aiofiles.open(path, "w") as f:
+                await f.write(message)
+            await send_file_to_room(client, room_id, path, store=store)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    kwargs.pop("split", None)
+    pages = _paginate(message, page_size)
+    pager.put(room_id, pages[1:], dict(kwargs, more_command=more_command))
+    return await _send_page(
+        client, room_id, pages[0], len(pages) - 1, more_command, kwargs)
+
 
+async def send_next_page(client, room_id):
+    """Send the next page of the last long output in a room.
 
-async def send_image_to_room(client, room_id, image):
+    Returns False if there is no page left.
+    """
+    entry = pager.pop(room_id)
+    if entry is None:
+        return False
+    page, left, kwargs = entry
+    kwargs = dict(kwargs)
+    more_command = kwargs.pop("more_command")
+    await _send_page(client, room_id, page, left, more_command, kwargs)
+    return True
+
+
+async def _send_page(client, room_id, page, left, more_command, kwargs):
+    if left:
+        page = page.rstrip() + (
+            f"\n\n[{left} more page{'s' if left > 1 else ''}, "
+            f"send `{more_command}` to continue]")
+    return await send_text_to_room(client, room_id, page, **kwargs)
+
+
+async def send_image_to_room(client, room_id, image, store=None):
     """Send image to single room.
 
     Arguments:
@@ -108,13 +507,14 @@ async def send_image_to_room(client, room_id, image):
     client (nio.AsyncClient): The client to communicate with Matrix
     room_id (str): The ID of the room to send the message to
     image (str): file name/path of image
+    store (Storage): Bot storage to look up earlier uploads in
 
     """
     logger.debug(f"send_image_to_room {room_id} {image}")
-    await send_image_to_rooms(client, [room_id], image)
+    await send_image_to_rooms(client, [room_id], image, store=store)
 
 
-async def send_image_to_rooms(client, rooms, image):
+async def send_image_to_rooms(client, rooms, image, store=None, limit=FAN_OUT_LIMIT):
     """Send image to multiple rooms.
 
     Arguments:
@@ -122,6 +522,13 @@ async def send_image_to_rooms(client, rooms, image):
     client (nio.AsyncClient): The client to communicate with Matrix
     rooms (list): list of room_id-s
     image (str): file name/path of image
+    store (Storage): Bot storage to look up earlier uploads in. If the
+        same content was uploaded before, the upload is skipped.
+    limit (int): number of rooms sent to at the same time
+
+    The file is uploaded once and then sent to all rooms concurrently.
+    Returns a dict room_id -> error for the rooms it could not be sent
+    to, empty if all went well.
 
     This is a working example for a JPG image.
         "content": {
@@ -149,65 +556,68 @@ async def send_image_to_rooms(client, rooms, image):
             "No rooms are given. This should not happen. "
             "This file is being droppend and NOT sent."
         )
-        return
-    if not os.path.isfile(image):
+        return {}
+    # read the file once, off the event loop
+    media = await inspect_media(image, image=True)
+    if media is None:
         logger.debug(
             f"File {image} is not a file. Doesn't exist or "
             "is a directory."
             "This file is being droppend and NOT sent."
         )
-        return
+        return _all_failed(rooms, "not a file")
 
-    mime_type = magic.from_file(image, mime=True)  # e.g. "image/jpeg"
-    if not mime_type.startswith("image/"):
+    if not media.mimetype.startswith("image/"):  # e.g. "image/jpeg"
         logger.debug("Drop message because file does not have an image mime type.")
-        return
-
-    im = Image.open(image)
-    (width, height) = im.size  # im.size returns (width,height) tuple
+        return _all_failed(rooms, f"not an image: {media.mimetype}")
 
     # first do an upload of image, then send URI of upload to room
-    file_stat = await aiofiles.os.stat(image)
-    async with aiofiles.open(image, "r+b") as f:
-        resp, maybe_keys = await client.upload(
-            f,
-            content_type=mime_type,  # image/jpeg
-            filename=os.path.basename(image),
-            filesize=file_stat.st_size,
-        )
-    if isinstance(resp, UploadResponse):
-        logger.debug("Image was uploaded successfully to server. ")
+    content_uri = await _upload_file(client, media, store)
+    if content_uri is None:
+        logger.debug("Drop message because the image could not be uploaded.")
+        return _all_failed(rooms, "upload failed")
+
+    thumbnail_url, thumbnail_info = None, None
+    try:
+        thumbnail = await _upload_thumbnail(client, media, store)
+    except Exception:
+        logger.debug(f"Thumbnail of {image} failed, sending it without one.")
+        logger.debug(traceback.format_exc())
     else:
-        logger.debug(f"Failed to upload image. Failure response: {resp}")
+        if thumbnail is None:
+            # small and static, it is its own thumbnail
+            thumbnail = (content_uri, media.mimetype, media.size,
+                         media.width, media.height)
+        thumbnail_url = thumbnail[0]
+        thumbnail_info = {
+            "w": thumbnail[3],
+            "h": thumbnail[4],
+            "mimetype": thumbnail[1],
+            "size": thumbnail[2],
+        }
 
     content = {
-        "body": os.path.basename(image),  # descriptive title
+        "body": media.filename,  # descriptive title
         "info": {
-            "size": file_stat.st_size,
-            "mimetype": mime_type,
-            "thumbnail_info": None,  # TODO
-            "w": width,  # width in pixel
-            "h": height,  # height in pixel
-            "thumbnail_url": None,  # TODO
+            "size": media.size,
+            "mimetype": media.mimetype,
+            "thumbnail_info": thumbnail_info,
+            "w": media.width,  # width in pixel
+            "h": media.height,  # height in pixel
+            "thumbnail_url": thumbnail_url,
         },
         "msgtype": "m.image",
-        "url": resp.content_uri,
+        "url": content_uri,
     }
 
-    try:
-        for room_id in rooms:
-            await client.room_send(
-                room_id, message_type="m.room.message", content=content
-            )
-            logger.debug(f'This image was sent: "{image}" to room "{room_id}".')
-    except Exception:
-        logger.debug(
-            f"Image send of file {image} failed. " "Sorry. Here is the traceback."
-        )
-        logger.debug(traceback.format_exc())
+    async def send_one(room_id):
+        await _send_content(client, room_id, content)
+        logger.debug(f'This image was sent: "{image}" to room "{room_id}".')
 
+    return await _fan_out(rooms, send_one, limit)
 
-async def send_file_to_room(client, room_id, file):
+
+async def send_file_to_room(client, room_id, file, store=None):
     """Send file to single room.
 
     Arguments:
@@ -215,13 +625,14 @@ async def send_file_to_room(client, room_id, file):
     client (nio.AsyncClient): The client to communicate with Matrix
     room_id (str): The ID of the room to send the file to
     file (str): file name/path of file
+    store (Storage): Bot storage to look up earlier uploads in
 
     """
     logger.debug(f"send_file_to_room {room_id} {file}")
-    await send_file_to_rooms(client, [room_id], file)
+    await send_file_to_rooms(client, [room_id], file, store=store)
 
 
-async def send_file_to_rooms(client, rooms, file):
+async def send_file_to_rooms(client, rooms, file, store=None, limit=FAN_OUT_LIMIT):
     """Send file to multiple rooms.
 
     Upload file to server and then send link to rooms.
@@ -240,6 +651,13 @@ async def send_file_to_rooms(client, rooms, file):
     room_id (str): The ID of the room to send the file to
     rooms (list): list of room_id-s
     file (str): file name/path of file
+    store (Storage): Bot storage to look up earlier uploads in. If the
+        same content was uploaded before, the upload is skipped.
+    limit (int): number of rooms sent to at the same time
+
+    The file is uploaded once and then sent to all rooms concurrently.
+    Returns a dict room_id -> error for the rooms it could not be sent
+    to, empty if all went well.
 
     This is a working example for a PDF file.
     It can be viewed or downloaded from:
@@ -272,14 +690,16 @@ async def send_file_to_rooms(client, rooms, file):
             "No rooms are given. This should not happen. "
             "This file is being droppend and NOT sent."
         )
-        return
-    if not os.path.isfile(file):
+        return {}
+    # read the file once, off the event loop
+    media = await inspect_media(file)
+    if media is None:
         logger.debug(
             f"File {file} is not a file. Doesn't exist or "
             "is a directory."
             "This file is being droppend and NOT sent."
         )
-        return
+        return _all_failed(rooms, "not a file")
 
     # # restrict to "txt", "pdf", "mp3", "ogg", "wav", ...
     # if not re.match("^.pdf$|^.txt$|^.doc$|^.xls$|^.mobi$|^.mp3$",
@@ -291,7 +711,7 @@ async def send_file_to_rooms(client, rooms, file):
     #    return
 
     # 'application/pdf' "plain/text" "audio/ogg"
-    mime_type = magic.from_file(file, mime=True)
+    mime_type = media.mimetype
     # if ((not mime_type.startswith("application/")) and
     #        (not mime_type.startswith("plain/")) and
     #        (not mime_type.startswith("audio/"))):
@@ -305,27 +725,14 @@ async def send_file_to_rooms(client, rooms, file):
     # http://matrix-nio.readthedocs.io/en/latest/nio.html#nio.AsyncClient.upload
     # then send URI of upload to room
 
-    file_stat = await aiofiles.os.stat(file)
-    async with aiofiles.open(file, "r+b") as f:
-        resp, maybe_keys = await client.upload(
-            f,
-            content_type=mime_type,  # application/pdf
-            filename=os.path.basename(file),
-            filesize=file_stat.st_size,
-        )
-    if isinstance(resp, UploadResponse):
-        logger.debug(f"File was uploaded successfully to server. Response is: {resp}")
-    else:
+    content_uri = await _upload_file(client, media, store)  # application/pdf
+    if content_uri is None:
         logger.info(
             "Bot failed to upload. "
             "Please retry. This could be temporary issue on your server. "
             "Sorry."
         )
-        logger.info(
-            f'file="{file}"; mime_type="{mime_type}"; '
-            f'filessize="{file_stat.st_size}"'
-            f"Failed to upload: {resp}"
-        )
+        return _all_failed(rooms, "upload failed")
 
     # determine msg_type:
     if mime_type.startswith("audio/"):
@@ -336,18 +743,88 @@ async def send_file_to_rooms(client, rooms, file):
         msg_type = "m.file"
 
     content = {
-        "body": os.path.basename(file),  # descriptive title
-        "info": {"size": file_stat.st_size, "mimetype": mime_type,},  # noqa
+        "body": media.filename,  # descriptive title
+        "info": {"size": media.size, "mimetype": mime_type,},  # noqa
         "msgtype": msg_type,
-        "url": resp.content_uri,
+        "url": content_uri,
     }
 
-    try:
-        for room_id in rooms:
-            await client.room_send(
-                room_id, message_type="m.room.message", content=content
-            )
-            logger.debug(f'This file was sent: "{file}" to room "{room_id}".')
-    except Exception:
-        logger.debug(f"File send of file {file} failed. Sorry. Here is the traceback.")
-        logger.debug(traceback.format_exc())
+    async def send_one(room_id):
+        await _send_content(client, room_id, content)
+        logger.debug(f'This file was sent: "{file}" to room "{room_id}".')
+
+    return await _fan_out(rooms, send_one, limit)
+
+
+async def _upload_file(client, media, store=None):
+    """Upload a file unless the same content was uploaded before.
+
+    The content read by inspect_media() is uploaded from memory, only
+    files too large to keep in memory are read from disk again.
+
+    Arguments:
+    ---------
+    client (nio.AsyncClient): The client to communicate with Matrix
+    media (MediaInfo): the inspected file
+    store (Storage): Bot storage to look up earlier uploads in
+
+    Returns the mxc:// URI of the content or None if the upload failed.
+    """
+    if store is not None:
+        content_uri = await store.get_media_uri(media.digest, media.size, media.mimetype)
+        if content_uri is not None:
+            logger.debug(f"Reusing earlier upload {content_uri} of {media.path}")
+            return content_uri
+
+    with REQUEST_SECONDS.time("upload"):
+        resp, maybe_keys = await outbox.upload(
+            client,
+            media.data if media.data is not None else media.path,
+            content_type=media.mimetype,
+            filename=media.filename,
+            filesize=media.size,
+        )
+    if not isinstance(resp, UploadResponse):
+        logger.info(
+            f'file="{media.path}"; mime_type="{media.mimetype}"; '
+            f'filessize="{media.size}"'
+            f"Failed to upload: {resp}"
+        )
+        return None
+
+    logger.debug(f"File was uploaded successfully to server. Response is: {resp}")
+    if store is not None:
+        await store.put_media_uri(media.digest, media.size, media.mimetype, resp.content_uri)
+    return resp.content_uri
+
+
+async def _upload_thumbnail(client, media, store=None):
+    """Render and upload the thumbnail of an image, once per content.
+
+    Returns (content_uri, mimetype, size, w, h) of the thumbnail or None
+    if the image is small and static enough to be its own thumbnail.
+    """
+    if media.is_own_thumbnail():
+        return None
+    if store is not None:
+        cached = await store.get_thumbnail(media.digest, media.size, media.mimetype)
+        if cached is not None:
+            return tuple(cached)
+
+    source = media.data if media.data is not None else media.path
+    thumbnail = await make_thumbnail(source)
+    with REQUEST_SECONDS.time("upload"):
+        resp, maybe_keys = await outbox.upload(
+            client,
+            thumbnail.data,
+            content_type=thumbnail.mimetype,
+            filename="thumbnail-" + media.filename,
+            filesize=len(thumbnail.data),
+        )
+    if not isinstance(resp, UploadResponse):
+        raise RuntimeError(f"Failed to upload thumbnail: {resp}")
+    result = (resp.content_uri, thumbnail.mimetype, len(thumbnail.data),
+              thumbnail.width, thumbnail.height)
+    if store is not None:
+        await store.put_thumbnail(media.digest, media.size, media.mimetype, result)
+    return result
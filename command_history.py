@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+r"""command_history.py.
+
+This file implements the history of command invocations
+- every dispatched command is recorded with its alias, room, user, the
+  time it waited in the room queue, its run time, exit code and the size
+  of its output
+- recording only appends to a list in memory, a background task writes
+  the list to the Storage in one batch every few seconds, so recording
+  never delays a reply
+- history older than the retention period is compacted into one row per
+  day and alias (see Storage.compact_command_history), so the database
+  stays small
+
+"""
+
+import asyncio
+import logging
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# seconds between two compactions
+COMPACT_INTERVAL = 3600
+
+
+class CommandHistory(object):
+    """Buffered recorder of command invocations."""
+
+    def __init__(self, store, flush_interval: float = 5,
+                 max_buffer: int = 1000, retention_days: float = 30):
+        """Initialize.
+
+        Arguments:
+        ---------
+            store (Storage): Bot storage the history is written to
+            flush_interval (float): seconds between two writes of the buffer
+            max_buffer (int): records kept in memory at most; if the
+                Storage falls behind, the oldest records are dropped
+            retention_days (float): days the detailed history is kept
+                before it is compacted
+
+        """
+        self.store = store
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.retention_days = retention_days
+        self._buffer = []
+        self._task = None
+        self.dropped = 0
+
+    def record(self, ts: float, alias: str, script: str, room_id: str,
+               sender: str, queue_wait: float, run_time: float,
+               exit_code: Optional[int], output_bytes: Optional[int]):
+        """Remember one finished command, without any I/O.
+
+        Arguments:
+        ---------
+            ts (float): unix time the command arrived
+            alias (str): the alias that was used, e.g. "weather"
+            script (str): the script or builtin method it maps to
+            room_id (str): The ID of the room the command came from
+            sender (str): user ID of the sender
+            queue_wait (float): seconds between arrival and start
+            run_time (float): seconds from start to the reply being sent
+            exit_code (int): exit code of the script, 0 for builtins,
+                None if there is none, e.g. for a failed script start
+            output_bytes (int): size of the script output in bytes,
+                None for builtins
+
+        """
+        if len(self._buffer) >= self.max_buffer:
+            del self._buffer[0]
+            self.dropped += 1
+        self._buffer.append((ts, alias, script, room_id, sender, queue_wait,
+                             run_time, exit_code, output_bytes))
+
+    def start(self):
+        """Start writing and compacting in the background."""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop the background task and write what is left."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        """Write all buffered records to the Storage."""
+        rows, self._buffer = self._buffer, []
+        if not rows:
+            return
+        try:
+            await self.store.add_command_history(rows)
+        except Exception:
+            # keep them for the next try, newer records go after them,
+            # the oldest are dropped beyond max_buffer
+            self._buffer[:0] = rows
+            excess = len(self._buffer) - self.max_buffer
+            if excess > 0:
+                del self._buffer[:excess]
+                self.dropped += excess
+                logger.warning(f"Dropped {excess} command history entries "
+                               "that could not be written.")
+            raise
+
+    async def compact(self):
+        """Compact the history older than the retention period."""
+        before = time.time() - self.retention_days * 86400
+        compacted = await self.store.compact_command_history(before)
+        if compacted:
+            logger.info(f"Compacted {compacted} command history entries.")
+
+    async def _run(self):
+        next_compaction = time.monotonic()
+        while True:
+            try:
+                if time.monotonic() >= next_compaction:
+                    next_compaction += COMPACT_INTERVAL
+                    await self.compact()
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Writing the command history failed")
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+r"""command_index.py.
+
+This file implements the lookup table used to dispatch commands
+- one frozen dict from lowercase alias to its handler, covering the
+  builtins, the aliases.yaml entries and the executable scripts
+- dispatching a command is a single dict lookup
+- the output of the `list` command is rendered once at build time
+
+"""
+
+import json
+import logging
+from collections import namedtuple
+from types import MappingProxyType
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+BUILTIN = "builtin"
+SCRIPT = "script"
+
+# kind (str): BUILTIN or SCRIPT
+# target (str): name of the Command method for builtins,
+#   file name of the script in the scripts dir for scripts
+# options (Mapping): options of the script from aliases.yaml,
+#   e.g. cache_ttl
+CommandEntry = namedtuple("CommandEntry", ["kind", "target", "options"])
+
+NO_OPTIONS = MappingProxyType({})
+
+# alias -> Command method, answered by the bot itself without a script
+BUILTIN_COMMANDS = {
+    "echo": "_echo",
+    "help": "_show_help",
+    "man": "_show_help",
+    "hilfe": "_show_help",
+    "help.sh": "_show_help",
+    "info": "_show_info",
+    "source": "_show_info",
+    "list": "_list_commands",
+    "commands": "_list_commands",
+    "ls": "_list_commands",
+    "more": "_more",
+}
+
+
+class CommandIndex(object):
+    """Frozen alias lookup table built from the configured aliases."""
+
+    def __init__(self, aliases: Dict[str, List[str]],
+                 options: Dict[str, dict] = None):
+        """Build the table.
+
+        Builtins take precedence over scripts. If two scripts claim the
+        same alias, the script whose file name sorts first keeps it.
+
+        Arguments:
+        ---------
+            aliases (dict): script file name -> list of aliases, as
+                returned by Config.getaliases()
+            options (dict): script file name -> options of the script
+
+        """
+        options = options or {}
+        table = {
+            alias: CommandEntry(BUILTIN, method, NO_OPTIONS)
+            for alias, method in BUILTIN_COMMANDS.items()
+        }
+        for script in sorted(aliases):
+            script_options = MappingProxyType(dict(options.get(script, {})))
+            for alias in aliases[script]:
+                alias = str(alias).lower()
+                entry = table.get(alias)
+                if entry is None:
+                    table[alias] = CommandEntry(SCRIPT, script, script_options)
+                elif entry.target != script:
+                    logger.warning(
+                        f"Alias {alias} of {script} is already taken by "
+                        f"{entry.target} and will be ignored.")
+        self.aliases = aliases
+        self.table = MappingProxyType(table)
+        self.listing = json.dumps(aliases, sort_keys=True, indent=4)
+
+    def get(self, alias: str) -> Optional[CommandEntry]:
+        """Return the entry for a lowercase alias or None if unknown."""
+        return self.table.get(alias)
+
+    def __len__(self):
+        """Return the number of known aliases."""
+        return len(self.table)
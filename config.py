@@ -15,6 +15,7 @@ import sys
 import glob
 from typing import List, Any
 from errors import ConfigError
+from command_index import CommandIndex
 
 logger = logging.getLogger()
 
@@ -91,9 +92,77 @@ class Config(object):
         self.command_prefix = self._get_cfg(["command_prefix"], default="!")
         self.scripts_dir = self._get_cfg(["script_dir"], default="scripts")
         self.aliases_yaml = self._get_cfg(["aliases_yaml"], default="aliases.yaml")
-        self.aliases = self.getaliases(self.aliases_yaml, self.scripts_dir)
+        self.aliases, self.alias_options = self.getaliases(
+            self.aliases_yaml, self.scripts_dir)
+        self.commands = CommandIndex(self.aliases, self.alias_options)
+        self.aliases_reload_interval = float(self._get_cfg(
+            ["aliases_reload_interval"], default=5, required=False))
 
         self.scripts_path_abs = os.path.abspath(self.scripts_dir)
+        self.script_max_concurrent = int(self._get_cfg(
+            ["script_max_concurrent"], default=4, required=False))
+        self.script_timeout = float(self._get_cfg(
+            ["script_timeout"], default=60, required=False))
+        self.script_plugins = self._get_cfg(
+            ["script_plugins"], default=True, required=False)
+        self.script_workers = int(self._get_cfg(
+            ["script_workers"], default=0, required=False))
+        self.script_worker_max_jobs = int(self._get_cfg(
+            ["script_worker_max_jobs"], default=100, required=False))
+        self.script_worker_max_memory = int(self._get_cfg(
+            ["script_worker_max_memory"], default=256, required=False))
+        self.result_cache_size = int(self._get_cfg(
+            ["result_cache_size"], default=256, required=False))
+        self.stream_edit_interval = float(self._get_cfg(
+            ["stream_edit_interval"], default=2, required=False))
+        self.output_inline_limit = int(self._get_cfg(
+            ["output", "inline_limit"], default=8000, required=False))
+        self.output_page_size = int(self._get_cfg(
+            ["output", "page_size"], default=8000, required=False))
+        self.output_file_limit = int(self._get_cfg(
+            ["output", "file_limit"], default=65536, required=False))
+        self.send_room_rate = float(self._get_cfg(
+            ["send", "room_rate"], default=1, required=False))
+        self.send_room_burst = int(self._get_cfg(
+            ["send", "room_burst"], default=5, required=False))
+        self.send_account_rate = float(self._get_cfg(
+            ["send", "account_rate"], default=5, required=False))
+        self.send_account_burst = int(self._get_cfg(
+            ["send", "account_burst"], default=20, required=False))
+        self.send_merge_limit = int(self._get_cfg(
+            ["send", "merge_limit"], default=4000, required=False))
+        self.history_enabled = self._get_cfg(
+            ["history", "enabled"], default=True, required=False)
+        self.history_flush_interval = float(self._get_cfg(
+            ["history", "flush_interval"], default=5, required=False))
+        self.history_retention_days = float(self._get_cfg(
+            ["history", "retention_days"], default=30, required=False))
+        self.metrics_enabled = self._get_cfg(
+            ["metrics", "enabled"], default=False, required=False)
+        self.metrics_host = self._get_cfg(
+            ["metrics", "host"], default="127.0.0.1", required=False)
+        self.metrics_port = int(self._get_cfg(
+            ["metrics", "port"], default=9469, required=False))
+        self.loop_monitor_threshold = float(self._get_cfg(
+            ["loop_monitor", "threshold"], default=0.1, required=False))
+        self.loop_monitor_interval = float(self._get_cfg(
+            ["loop_monitor", "interval"], default=0.5, required=False))
+        self.reconnect_initial_delay = float(self._get_cfg(
+            ["reconnect", "initial_delay"], default=1, required=False))
+        self.reconnect_max_delay = float(self._get_cfg(
+            ["reconnect", "max_delay"], default=60, required=False))
+        self.sync_filter_enabled = self._get_cfg(
+            ["sync_filter", "enabled"], default=True, required=False)
+        self.sync_filter_timeline_limit = int(self._get_cfg(
+            ["sync_filter", "timeline_limit"], default=20, required=False))
+        self.sync_filter_lazy_load_members = self._get_cfg(
+            ["sync_filter", "lazy_load_members"], default=False,
+            required=False)
+        if self.script_max_concurrent < 1:
+            raise ConfigError("script_max_concurrent must be at least 1")
+        for name in ("inline_limit", "page_size", "file_limit"):
+            if getattr(self, f"output_{name}") < 1:
+                raise ConfigError(f"output.{name} must be at least 1")
 
 
         if not self.user_password and not self.access_token:
@@ -140,15 +209,57 @@ class Config(object):
         # We found the option. Return it
         return config
 
+    def reload_aliases(self):
+        """Rebuild the alias table from aliases.yaml and the scripts dir.
+
+        The new table replaces the old one in a single assignment.
+        Commands that already picked up the old table finish on it.
+        If aliases.yaml can't be read, the old table is kept.
+        """
+        try:
+            aliases, options = self.getaliases(
+                self.aliases_yaml, self.scripts_dir)
+            commands = CommandIndex(aliases, options)
+        except (OSError, yaml.YAMLError, ConfigError) as e:
+            logger.error(f"Keeping the old aliases, reload failed: {e}")
+            return
+        self.aliases = aliases
+        self.alias_options = options
+        self.commands = commands
+        logger.info(f"Reloaded aliases, {len(commands)} commands known.")
+
     def getaliases(self, aliases_path: str, scripts_dir: str):
+        """Read the aliases of all scripts.
+
+        An entry of aliases.yaml is either a list of aliases or a mapping
+        with the list under `aliases` and further options of the script,
+        e.g. `cache_ttl`.
+
+        Returns a tuple of two dicts: script -> list of aliases and
+        script -> options.
+        """
         with open(aliases_path, 'r') as aliasfile:
-            aliases = yaml.safe_load(aliasfile)
+            entries = yaml.safe_load(aliasfile) or {}
+        aliases = {}
+        options = {}
+        for script, entry in entries.items():
+            if isinstance(entry, dict):
+                entry = dict(entry)
+                aliases[script] = list(entry.pop("aliases", []))
+                options[script] = entry
+            elif isinstance(entry, list):
+                aliases[script] = list(entry)
+            else:
+                raise ConfigError(
+                    f"Aliases of {script} in {aliases_path} must be a list "
+                    "or a mapping")
         for path in glob.glob(scripts_dir+"/*"):
-            if os.access(path, os.X_OK):
+            if os.path.isfile(path) and os.access(path, os.X_OK):
                 script = os.path.split(path)[1]
                 script_name, _ = os.path.splitext(script)
                 if script in aliases:
-                    aliases[script].append(script_name)
+                    if script_name not in aliases[script]:
+                        aliases[script].append(script_name)
                 else:
                     aliases[script] = [ script_name ]
-        return aliases
+        return aliases, options
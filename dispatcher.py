@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+r"""dispatcher.py.
+
+This file implements the dispatching of incoming events to their handlers
+- every room has its own queue, so rooms are served in parallel while the
+  messages of one room are handled in the order they arrived
+- every room has a second, priority lane for cheap builtin commands, so
+  they are never stuck behind a slow script in the same room
+- the worker of a lane exits once its queue is drained and is recreated
+  on the next event, so idle rooms cost nothing
+
+"""
+
+import asyncio
+import logging
+import traceback
+from typing import Awaitable, Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+NORMAL = "normal"
+PRIORITY = "priority"
+
+
+class Dispatcher(object):
+    """Run event handlers concurrently over rooms, in order within a room."""
+
+    def __init__(self):
+        """Initialize."""
+        # (room_id, lane) -> queue of handler factories
+        self._queues: Dict[Tuple[str, str], asyncio.Queue] = {}
+        # (room_id, lane) -> worker task draining the queue
+        self._workers: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    def submit(self, room_id: str,
+               handler: Callable[[], Awaitable[None]],
+               priority: bool = False):
+        """Queue a handler for a room and return immediately.
+
+        Arguments:
+        ---------
+            room_id (str): The room the event came from
+            handler (callable): coroutine function without arguments,
+                e.g. `command.process`
+            priority (bool): whether to use the priority lane of the room
+
+        """
+        key = (room_id, PRIORITY if priority else NORMAL)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = asyncio.Queue()
+        queue.put_nowait(handler)
+        if key not in self._workers:
+            self._workers[key] = asyncio.ensure_future(self._work(key, queue))
+
+    def queue_depth(self) -> int:
+        """Return the number of handlers waiting over all rooms."""
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    async def _work(self, key: Tuple[str, str], queue: asyncio.Queue):
+        try:
+            while not queue.empty():
+                handler = queue.get_nowait()
+                try:
+                    await handler()
+                except Exception:
+                    logger.error(
+                        f"Handler for room {key[0]} failed:\n"
+                        f"{traceback.format_exc()}")
+        finally:
+            # Nothing is awaited between the empty() check and here, so no
+            # handler can be submitted to the queue without a worker.
+            del self._workers[key]
+            del self._queues[key]
+
+    async def close(self):
+        """Cancel all workers, e.g. on shutdown."""
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
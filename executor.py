@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+
+r"""executor.py.
+
+This file implements the asynchronous execution of script commands
+- scripts run as asyncio subprocesses, so the event loop keeps serving
+  sync, replies in other rooms and key verification while they run
+- a global semaphore bounds how many scripts run at the same time
+- every script gets a wall-clock timeout after which it is killed
+- Python scripts that are plugins (see plugins.py) run in-process instead
+- other Python scripts can run in a pool of warm workers (worker_pool.py)
+- results of scripts with a cache TTL are reused (see result_cache.py)
+- for scripts that opt in, identical commands that are already running
+  are not started again, every caller gets the result of the one run
+  (single-flight)
+
+"""
+
+import asyncio
+import codecs
+import hashlib
+import json
+import logging
+import os
+import signal
+import traceback
+from typing import Awaitable, Callable, Dict, List
+
+from metrics import SCRIPT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# seconds to collect the output of a killed script, its pipes may be held
+# open by a process that left its process group
+KILL_DRAIN_TIMEOUT = 2
+
+# environment variables that differ per room and are not part of the key
+ROOM_ENV = ("K9_ROOM",)
+
+
+def command_key(argv: List[str], env: Dict[str, str]) -> str:
+    """Return the key under which identical commands are merged.
+
+    Arguments are stripped and empty ones dropped, so `weather  wien` and
+    `weather wien` are the same command. The environment is part of the
+    key except for the room specific variables, so all rooms share a key.
+    """
+    args = [arg.strip() for arg in argv[1:] if arg.strip()]
+    room_free_env = sorted(
+        (name, value) for name, value in env.items() if name not in ROOM_ENV)
+    raw = json.dumps([argv[0], args, room_free_env])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class ScriptResult(object):
+    """Outcome of a single script run."""
+
+    def __init__(self, returncode: int, stdout: str, stderr: str,
+                 timed_out: bool = False):
+        """Initialize.
+
+        Arguments:
+        ---------
+            returncode (int): exit code of the script, -1 if it was killed
+            stdout (str): captured standard output
+            stderr (str): captured standard error
+            timed_out (bool): whether the script hit the wall-clock timeout
+
+        """
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+
+
+class ScriptExecutor(object):
+    """Run script commands without blocking the event loop."""
+
+    def __init__(self, max_concurrent: int = 4, timeout: float = 60,
+                 plugins=None, pool=None, cache=None):
+        """Initialize.
+
+        Arguments:
+        ---------
+            max_concurrent (int): number of scripts allowed to run at once
+                over all rooms
+            timeout (float): wall-clock seconds after which a script is
+                killed
+            plugins (PluginLoader): loader for in-process plugins,
+                None to always start a subprocess
+            pool (WorkerPool): warm workers for Python scripts,
+                None to start a subprocess per call
+            cache (ResultCache): cache for results of scripts with a TTL,
+                None to never cache
+
+        """
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.plugins = plugins
+        self.pool = pool
+        self.cache = cache
+        # command key -> task of the run all identical callers wait for
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.running = 0
+
+    async def run(self, argv: List[str], env: Dict[str, str],
+                  cache_ttl: float = 0, coalesce: bool = False,
+                  pooled: bool = True) -> ScriptResult:
+        """Run argv as a plugin or subprocess and collect its output.
+
+        Waits for a free slot of the global concurrency limit first.
+        The wall-clock timeout only starts once the script is running.
+
+        Arguments:
+        ---------
+            argv (list): command and its arguments, e.g. ['date', '--utc']
+            env (dict): environment of the subprocess
+            cache_ttl (float): seconds a successful result may be reused,
+                0 to always run the script
+            coalesce (bool): whether to share the run with identical
+                commands that are in flight, e.g. from other rooms; only
+                for scripts that neither depend on the room nor have
+                side effects
+            pooled (bool): whether a Python script may run in the worker
+                pool, False for scripts that keep state in libraries
+
+        """
+        use_cache = self.cache is not None and cache_ttl > 0
+        if not use_cache and not coalesce:
+            return await self._run_limited(argv, env, pooled)
+
+        key = command_key(argv, env)
+        if use_cache:
+            cached = await self.cache.get(key)
+            if cached is not None:
+                logger.debug(f"Using cached result of {argv}")
+                return ScriptResult(0, *cached)
+        if not coalesce:
+            return await self._run_cached(key, argv, env, cache_ttl, pooled)
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                self._run_cached(key, argv, env, cache_ttl, pooled))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            logger.debug(f"Joining the running command {argv}")
+        # A cancelled caller must not cancel the run of the others
+        return await asyncio.shield(task)
+
+    async def stream(self, argv: List[str], env: Dict[str, str],
+                     on_output: Callable[[str], Awaitable[None]]
+                     ) -> ScriptResult:
+        """Run argv as a subprocess and pass on stdout as it arrives.
+
+        Streaming runs bypass plugins, the worker pool, the cache and
+        coalescing, but share the concurrency limit and the timeout.
+
+        Arguments:
+        ---------
+            argv (list): command and its arguments
+            env (dict): environment of the subprocess
+            on_output (coroutine function): called with every decoded
+                chunk of stdout
+
+        Returns the ScriptResult, its stdout holds the complete output.
+
+        """
+        async with self._semaphore:
+            self.running += 1
+            try:
+                with SCRIPT_SECONDS.time(argv[0]):
+                    return await self._stream(argv, env, on_output)
+            finally:
+                self.running -= 1
+
+    async def _stream(self, argv: List[str], env: Dict[str, str],
+                      on_output: Callable[[str], Awaitable[None]]
+                      ) -> ScriptResult:
+        proc = await asyncio.create_subprocess_exec(
+            *argv,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+            start_new_session=True,
+        )
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        stdout = []
+
+        async def read_stdout():
+            while True:
+                data = await proc.stdout.read(4096)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    stdout.append(text)
+                    await on_output(text)
+                if not data:
+                    return
+
+        stderr_task = asyncio.ensure_future(proc.stderr.read())
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(read_stdout(), proc.wait()),
+                timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Command {argv[0]} exceeded the timeout of "
+                f"{self.timeout}s and is being killed.")
+            stderr = await _kill_and_drain(proc, stderr_task, b"")
+            return ScriptResult(
+                -1, "".join(stdout), _decode(stderr), timed_out=True)
+        except BaseException:
+            stderr_task.cancel()
+            await _kill_and_drain(proc, stderr_task, b"")
+            raise
+        return ScriptResult(
+            proc.returncode, "".join(stdout), _decode(await stderr_task))
+
+    async def _run_cached(self, key: str, argv: List[str],
+                          env: Dict[str, str],
+                          cache_ttl: float, pooled: bool) -> ScriptResult:
+        result = await self._run_limited(argv, env, pooled)
+        if (self.cache is not None and cache_ttl > 0
+                and result.returncode == 0 and not result.timed_out):
+            await self.cache.put(
+                key, cache_ttl, result.stdout, result.stderr)
+        return result
+
+    async def _run_limited(self, argv: List[str], env: Dict[str, str],
+                           pooled: bool = True) -> ScriptResult:
+        async with self._semaphore:
+            self.running += 1
+            try:
+                with SCRIPT_SECONDS.time(argv[0]):
+                    entry = None
+                    if self.plugins is not None:
+                        entry = await self.plugins.get(argv[0])
+                    if entry is not None:
+                        return await self._run_plugin(entry, argv, env)
+                    if (pooled and self.pool is not None
+                            and self.pool.handles(argv)):
+                        return await self._run_pooled(argv, env)
+                    return await self._run(argv, env)
+            finally:
+                self.running -= 1
+
+    async def _run_plugin(self, entry, argv: List[str],
+                          env: Dict[str, str]) -> ScriptResult:
+        try:
+            output = await asyncio.wait_for(
+                entry(argv[1:], env), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Plugin {argv[0]} exceeded the timeout of "
+                f"{self.timeout}s and was cancelled.")
+            return ScriptResult(-1, "", "", timed_out=True)
+        except Exception:
+            return ScriptResult(1, "", traceback.format_exc())
+        return ScriptResult(0, output or "", "")
+
+    async def _run_pooled(self, argv: List[str],
+                          env: Dict[str, str]) -> ScriptResult:
+        try:
+            return await self.pool.run(argv, env, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Command {argv[0]} exceeded the timeout of "
+                f"{self.timeout}s, its worker is being replaced.")
+            return ScriptResult(-1, "", "", timed_out=True)
+
+    async def _run(self, argv: List[str], env: Dict[str, str]) -> ScriptResult:
+        # a session of its own, so the timeout also kills what the script
+        # started, e.g. a curl that would keep the pipes open
+        proc = await asyncio.create_subprocess_exec(
+            *argv,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+            start_new_session=True,
+        )
+        output = asyncio.gather(proc.stdout.read(), proc.stderr.read())
+        try:
+            # the output is shielded, so what was read so far survives the
+            # timeout; the script is awaited within the timeout too, it may
+            # close its pipes and keep running
+            (stdout, stderr), _ = await asyncio.wait_for(
+                asyncio.gather(asyncio.shield(output), proc.wait()),
+                timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Command {argv[0]} exceeded the timeout of "
+                f"{self.timeout}s and is being killed.")
+            stdout, stderr = await _kill_and_drain(proc, output, (b"", b""))
+            return ScriptResult(
+                -1, _decode(stdout), _decode(stderr), timed_out=True)
+        except asyncio.CancelledError:
+            output.cancel()
+            await _kill_and_drain(proc, output, (b"", b""))
+            raise
+        return ScriptResult(proc.returncode, _decode(stdout), _decode(stderr))
+
+
+async def _kill_and_drain(proc, output: asyncio.Future, default):
+    """Kill the script and every process it started in its session.
+
+    Returns the result of output, the reads of its pipes, or default if
+    they don't finish within KILL_DRAIN_TIMEOUT, e.g. because a process
+    that left the session still holds them open. The process is only
+    awaited as long, asyncio reports its exit once the pipes are closed.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # all of them are gone already
+        pass
+    try:
+        result, _ = await asyncio.wait_for(
+            asyncio.gather(output, proc.wait(), return_exceptions=True),
+            timeout=KILL_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        output.cancel()
+        return default
+    return default if isinstance(result, BaseException) else result
+
+
+def _decode(data: bytes) -> str:
+    return data.decode(errors="replace") if data else ""
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+r"""loop_monitor.py.
+
+This file implements a monitor of the asyncio event loop
+- a small task measures how late the loop wakes it up, i.e. the loop lag,
+  continuously and exports it as a histogram (see metrics.py)
+- every callback the loop runs, including each step of a task, is timed;
+  one that blocks the loop for longer than a threshold is logged and
+  counted, naming the coroutine that ran and where it continued to, so
+  blocking calls like a synchronous Popen or Image.open can be found
+
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from metrics import LOOP_LAG, SLOW_CALLBACKS
+
+logger = logging.getLogger(__name__)
+
+# the unpatched asyncio.Handle._run
+_original_run = asyncio.events.Handle._run
+
+_ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+
+def describe_callback(handle) -> str:
+    """Name the coroutine or function a loop callback ran.
+
+    For the step of a task this is the coroutine of the task and the
+    innermost await it is suspended at now, after the step.
+    """
+    callback = handle._callback
+    task = getattr(callback, "__self__", None)
+    if isinstance(task, asyncio.Task):
+        coro = task.get_coro()
+        name = getattr(coro, "__qualname__", repr(coro))
+        location = _suspended_at(coro)
+        if location:
+            return f"task {task.get_name()} {name} (next await at {location})"
+        return f"task {task.get_name()} {name}"
+    return getattr(callback, "__qualname__", repr(callback))
+
+
+def _suspended_at(coro) -> str:
+    # the innermost frame outside of asyncio itself, e.g. the line of a
+    # handler that awaits asyncio.sleep(), rather than the sleep
+    frame = None
+    while coro is not None:
+        current = getattr(coro, "cr_frame", None) or getattr(
+            coro, "gi_frame", None)
+        if current is not None and not current.f_code.co_filename.startswith(
+                _ASYNCIO_DIR):
+            frame = current
+        coro = getattr(coro, "cr_await", None) or getattr(
+            coro, "gi_yieldfrom", None)
+    if frame is None:
+        return ""
+    return (f"{os.path.relpath(frame.f_code.co_filename)}:{frame.f_lineno} "
+            f"in {frame.f_code.co_name}")
+
+
+def _coroutine_name(handle) -> str:
+    callback = handle._callback
+    task = getattr(callback, "__self__", None)
+    if isinstance(task, asyncio.Task):
+        coro = task.get_coro()
+        return getattr(coro, "__qualname__", type(coro).__name__)
+    return getattr(callback, "__qualname__", type(callback).__name__)
+
+
+class LoopMonitor(object):
+    """Measure the lag of the running loop and find slow callbacks."""
+
+    def __init__(self, threshold: float = 0.1, interval: float = 0.5):
+        """Initialize.
+
+        Arguments:
+        ---------
+            threshold (float): seconds a callback may block the loop
+                before it is reported, 0 to not time callbacks
+            interval (float): seconds between two lag measurements
+
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        """Start measuring, must be called from the running loop."""
+        if self.threshold > 0:
+            threshold = self.threshold
+
+            def timed_run(handle):
+                start = time.perf_counter()
+                try:
+                    _original_run(handle)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    if elapsed > threshold:
+                        _report(handle, elapsed)
+
+            asyncio.events.Handle._run = timed_run
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._measure_lag())
+
+    async def stop(self):
+        """Stop measuring and restore the loop's callbacks."""
+        asyncio.events.Handle._run = _original_run
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _measure_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            LOOP_LAG.observe(lag)
+            if self.threshold > 0 and lag > self.threshold:
+                logger.warning(f"Event loop lagged {lag * 1000:.0f}ms.")
+
+
+def _report(handle, elapsed: float):
+    try:
+        SLOW_CALLBACKS.inc(_coroutine_name(handle))
+        logger.warning(
+            f"Event loop blocked for {elapsed * 1000:.0f}ms by "
+            f"{describe_callback(handle)}")
+    except Exception:
+        # never let reporting break the loop
+        logger.exception("Reporting a slow callback failed")
@@ -15,31 +15,64 @@ file is automatically linted and beautified.
 
 import asyncio
 import logging
+import signal
 import sys
-from time import sleep
 from nio import (
     AsyncClient,
     AsyncClientConfig,
+    Event,
     RoomMessageText,
+    SyncError,
+    SyncResponse,
+    ToDeviceEvent,
     InviteMemberEvent,
     LoginError,
     LocalProtocolError,
     UpdateDeviceError,
     KeyVerificationEvent,
 )
-from aiohttp import (
-    ServerDisconnectedError,
-    ClientConnectionError
-)
+from alias_watcher import AliasWatcher
 from callbacks import Callbacks
+from chat_functions import outbox
+from command_history import CommandHistory
 from config import Config
+from dispatcher import Dispatcher
+from executor import ScriptExecutor
+from loop_monitor import LoopMonitor
+import metrics
+from plugins import PluginLoader
+from reconnect import ReconnectSupervisor
+from result_cache import ResultCache
+from worker_pool import WorkerPool
 from storage import Storage
+from sync_filter import build_sync_filter, sync_filter_id
 
 logger = logging.getLogger(__name__)
 handler = logging.StreamHandler(sys.stdout)
 logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
+def sync_token_rejected(response) -> bool:
+    """Whether the homeserver refused the given sync token or filter."""
+    if not isinstance(response, SyncError):
+        return False
+    status = getattr(response.transport_response, "status", None)
+    # auth and rate limit errors are no verdict on the token
+    return status is not None and 400 <= status < 500 and (
+        status not in (401, 403, 429))
+
+
+async def stop_all(steps):
+    """Await every step in turn, one that fails doesn't stop the others."""
+    for step in steps:
+        if not step:
+            continue
+        try:
+            await step()
+        except Exception:
+            logger.exception(f"Stopping {step.__qualname__} failed")
+
+
 async def main():  # noqa
     """Create bot as Matrix client and enter event loop."""
     # Read config file
@@ -56,110 +89,268 @@ async def main():  # noqa
     if config.loop_sleep_time:
         loop_sleep_time = int(config.loop_sleep_time)
 
+    # Report whatever blocks the event loop, from start-up on
+    loop_monitor = LoopMonitor(
+        threshold=config.loop_monitor_threshold,
+        interval=config.loop_monitor_interval,
+    )
+    loop_monitor.start()
+
+    # Stop cleanly on SIGTERM, like on Ctrl-C
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel)
+
     # Configure the database
     store = Storage(config.database_filepath)
 
-    # Configuration options for the AsyncClient
-    client_config = AsyncClientConfig(
-        max_limit_exceeded=0,
-        max_timeouts=0,
-        store_sync_tokens=True,
-        encryption_enabled=True,
-    )
+    # Created below, stopped in the finally block however the bot stops
+    alias_watcher = dispatcher = history = pool = metrics_runner = None
+    try:
+        # Configuration options for the AsyncClient
+        # Rate limited sends are not retried by nio, but by the outbox
+        # The sync token is kept in our database, not in nio's store
+        client_config = AsyncClientConfig(
+            max_limit_exceeded=0,
+            max_timeouts=0,
+            store_sync_tokens=False,
+            encryption_enabled=True,
+        )
 
-    # Initialize the matrix client
-    client = AsyncClient(
-        config.homeserver_url,
-        config.user_id,
-        device_id=config.device_id,
-        store_path=config.store_filepath,
-        config=client_config,
-    )
+        # Initialize the matrix client
+        client = AsyncClient(
+            config.homeserver_url,
+            config.user_id,
+            device_id=config.device_id,
+            store_path=config.store_filepath,
+            config=client_config,
+        )
 
 
-    # Set up event callbacks
-    callbacks = Callbacks(client, store, config)
-    client.add_event_callback(callbacks.message, (RoomMessageText,))
-    client.add_event_callback(callbacks.invite, (InviteMemberEvent,))
-    client.add_to_device_callback(
-        callbacks.accept_all_verify, (KeyVerificationEvent,))
+        # Scripts run as subprocesses next to the event loop
+        # Python scripts with a k9_main() entry point run in-process
+        plugins = None
+        if config.script_plugins:
+            plugins = PluginLoader(config.scripts_path_abs)
+        # Other Python scripts run in warm worker processes, if configured
+        if config.script_workers > 0:
+            pool = WorkerPool(
+                config.script_workers,
+                max_jobs=config.script_worker_max_jobs,
+                max_memory_mb=config.script_worker_max_memory,
+            )
+            await pool.start()
+        result_cache = ResultCache(store, maxsize=config.result_cache_size)
+        await result_cache.purge()
+        executor = ScriptExecutor(
+            max_concurrent=config.script_max_concurrent,
+            timeout=config.script_timeout,
+            plugins=plugins,
+            pool=pool,
+            cache=result_cache,
+        )
 
-    # Keep trying to reconnect on failure (with some time in-between)
-    while True:
-        try:
-            # Try to login with the configured username/password
+        # Replies leave through one queue within the send budget
+        outbox.configure(
+            room_rate=config.send_room_rate,
+            room_burst=config.send_room_burst,
+            account_rate=config.send_account_rate,
+            account_burst=config.send_account_burst,
+            merge_limit=config.send_merge_limit,
+        )
+
+        # Handlers run per room, in parallel to nio's callback loop
+        dispatcher = Dispatcher()
+
+        # Record which commands run, how long and for whom
+        if config.history_enabled:
+            history = CommandHistory(
+                store,
+                flush_interval=config.history_flush_interval,
+                retention_days=config.history_retention_days,
+            )
+            history.start()
+
+        # Set up event callbacks
+        callbacks = Callbacks(client, store, config, executor, dispatcher,
+                              history)
+        client.add_event_callback(callbacks.message, (RoomMessageText,))
+        client.add_event_callback(callbacks.invite, (InviteMemberEvent,))
+        client.add_to_device_callback(
+            callbacks.accept_all_verify, (KeyVerificationEvent,))
+
+        # Only sync what the callbacks above handle, built before the callbacks
+        # below are added, which merely count what arrives
+        sync_filter = None
+        if config.sync_filter_enabled:
+            sync_filter = build_sync_filter(
+                client,
+                timeline_limit=config.sync_filter_timeline_limit,
+                lazy_load_members=config.sync_filter_lazy_load_members,
+            )
+        filter_id = None
+
+        # Count every event and expose the metrics, if configured
+        async def count_event(room_or_event, event=None):
+            metrics.EVENTS.inc(type(event or room_or_event).__name__)
+        client.add_event_callback(count_event, (Event,))
+        client.add_to_device_callback(count_event, (ToDeviceEvent,))
+        metrics.observe_sync(client)
+        metrics.RUNNING_SCRIPTS.set_function(lambda: executor.running)
+        metrics.QUEUE_DEPTH.set_function(dispatcher.queue_depth, "dispatcher")
+        metrics.QUEUE_DEPTH.set_function(outbox.queue_depth, "outbox")
+        if config.metrics_enabled:
+            metrics_runner = await metrics.start_server(
+                config.metrics_host, config.metrics_port)
+
+        # Pick up changed aliases and scripts without a restart
+        alias_watcher = AliasWatcher(config, config.aliases_reload_interval)
+        alias_watcher.start()
+
+        # Keep trying to reconnect on failure, with a growing delay in-between
+        supervisor = ReconnectSupervisor(
+            initial_delay=config.reconnect_initial_delay,
+            max_delay=config.reconnect_max_delay,
+        )
+        client.add_response_callback(
+            lambda response: supervisor.connected(), (SyncResponse,))
+
+        # Remember where the sync stopped, the next start resumes from there
+        async def save_sync_token(response):
+            await store.put_sync_token(response.next_batch)
+        client.add_response_callback(save_sync_token, (SyncResponse,))
+
+        async def connect():
+            nonlocal filter_id
             try:
-                if config.access_token:
-                    logger.debug("Using access token from config file to log "
-                                 f"in. access_token={config.access_token}")
-
-                    client.restore_login(
-                        user_id=config.user_id,
-                        device_id=config.device_id,
-                        access_token=config.access_token
-                    )
-                else:
-                    logger.debug("Using password from config file to log in.")
-                    login_response = await client.login(
-                        password=config.user_password,
-                        device_name=config.device_name,
-                    )
-
-                    # Check if login failed
-                    if type(login_response) == LoginError:
-                        logger.error("Failed to login: "
-                                     f"{login_response.message}")
+                # The session survives a reconnect, only log in once
+                if not client.logged_in:
+                    # Try to login with the configured username/password
+                    try:
+                        if config.access_token:
+                            logger.debug("Using access token from config file to "
+                                         "log in. "
+                                         f"access_token={config.access_token}")
+
+                            client.restore_login(
+                                user_id=config.user_id,
+                                device_id=config.device_id,
+                                access_token=config.access_token
+                            )
+                        else:
+                            logger.debug(
+                                "Using password from config file to log in.")
+                            login_response = await client.login(
+                                password=config.user_password,
+                                device_name=config.device_name,
+                            )
+
+                            # Check if login failed
+                            if type(login_response) == LoginError:
+                                logger.error("Failed to login: "
+                                             f"{login_response.message}")
+                                return False
+                            logger.info((
+                                f"access_token of device {config.device_name}"
+                                f" is: \"{login_response.access_token}\""))
+                    except LocalProtocolError as e:
+                        # There's an edge case here where the user hasn't
+                        # installed the correct C dependencies. In that case, a
+                        # LocalProtocolError is raised on login.
+                        logger.fatal(
+                            "Failed to login. "
+                            "Have you installed the correct dependencies? "
+                            "Error: %s", e
+                        )
                         return False
-                    logger.info((f"access_token of device {config.device_name}"
-                                 f" is: \"{login_response.access_token}\""))
-            except LocalProtocolError as e:
-                # There's an edge case here where the user hasn't installed
-                # the correct C dependencies. In that case, a
-                # LocalProtocolError is raised on login.
-                logger.fatal(
-                    "Failed to login. "
-                    "Have you installed the correct dependencies? "
-                    "Error: %s", e
-                )
-                return False
-
-            # Login succeeded!
-            logger.debug(f"Logged in successfully as user {config.user_id} "
-                         f"with device {config.device_id}.")
-            # Sync encryption keys with the server
-            # Required for participating in encrypted rooms
-            if client.should_upload_keys:
-                await client.keys_upload()
-
-            if config.change_device_name:
-                content = {"display_name": config.device_name}
-                resp = await client.update_device(config.device_id,
-                                                  content)
-                if isinstance(resp, UpdateDeviceError):
-                    logger.debug(f"update_device failed with {resp}")
-                else:
-                    logger.debug(f"update_device successful with {resp}")
-
-            await client.sync(timeout=30000, full_state=True)
-            for device_id, olm_device in client.device_store[config.user_id].items():
-                logger.info("Setting up trust for my own "
-                            f"device {device_id} and session key "
-                            f"{olm_device.keys}.")
-                client.verify_device(olm_device)
-
-            
-
-            await client.sync_forever(timeout=30000, loop_sleep_time=loop_sleep_time, full_state=True)
-
-        except (ClientConnectionError, ServerDisconnectedError):
-            logger.warning(
-                "Unable to connect to homeserver, retrying in 15s...")
-
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        finally:
-            # Make sure to close the client connection on disconnect
-            await client.close()
+
+                    # Login succeeded!
+                    logger.debug(f"Logged in successfully as user "
+                                 f"{config.user_id} with device "
+                                 f"{config.device_id}.")
+
+                # Sync encryption keys with the server
+                # Required for participating in encrypted rooms
+                if client.should_upload_keys:
+                    await client.keys_upload()
+
+                # The filter is uploaded once, its ID is kept in the database
+                if sync_filter is not None and filter_id is None:
+                    filter_id = await sync_filter_id(client, store, sync_filter)
+
+                # The first sync of this run resumes from the last sync of the
+                # previous run, still with full state: nio keeps no rooms
+                # between runs, without their members and names a group
+                # room would look like a DM and K9_ROOM would change.
+                # A reconnect resumes from the last sync of this run.
+                since = None
+                if not supervisor.is_reconnect:
+                    if config.change_device_name:
+                        content = {"display_name": config.device_name}
+                        resp = await client.update_device(config.device_id,
+                                                          content)
+                        if isinstance(resp, UpdateDeviceError):
+                            logger.debug(f"update_device failed with {resp}")
+                        else:
+                            logger.debug(f"update_device successful with {resp}")
+
+                    since = await store.get_sync_token()
+                    if since:
+                        logger.debug(f"Resuming sync from {since}.")
+                        response = await client.sync(timeout=0, since=since,
+                                                     sync_filter=filter_id,
+                                                     full_state=True)
+                        if sync_token_rejected(response):
+                            logger.warning("The stored sync token or filter was "
+                                           f"rejected ({response.message}), "
+                                           "syncing full state.")
+                            await store.delete_sync_token()
+                            since = None
+                            if filter_id is not None:
+                                # the homeserver may have dropped the filter
+                                await store.delete_sync_filters()
+                                filter_id = await sync_filter_id(
+                                    client, store, sync_filter)
+                    if not since:
+                        logger.info("Syncing full state, this may take a while.")
+                        response = await client.sync(timeout=30000,
+                                                     sync_filter=filter_id,
+                                                     full_state=True)
+                    await client.run_response_callbacks([response])
+                    # The token of the first sync is on disk before the long
+                    # polls start, not only with the next batched commit
+                    await store.commit()
+                    for device_id, olm_device in client.device_store[
+                            config.user_id].items():
+                        logger.info("Setting up trust for my own "
+                                    f"device {device_id} and session key "
+                                    f"{olm_device.keys}.")
+                        client.verify_device(olm_device)
+
+                await client.sync_forever(timeout=30000,
+                                          loop_sleep_time=loop_sleep_time,
+                                          sync_filter=filter_id,
+                                          since=client.next_batch or since)
+            finally:
+                # Make sure to close the client connection on disconnect
+                await client.close()
+
+        return await supervisor.run(connect)
+    finally:
+        # The sync token is committed first, so the next start resumes from
+        # here even if a later step hangs. Nothing new comes in then, the
+        # queues are stopped and what they recorded is written, the
+        # database is closed last so pending writes are committed
+        await stop_all([
+            store.commit,
+            alias_watcher and alias_watcher.stop,
+            metrics_runner and metrics_runner.cleanup,
+            loop_monitor.stop,
+            dispatcher and dispatcher.close,
+            outbox.close,
+            history and history.stop,
+            pool and pool.close,
+            store.close,
+        ])
 
 try:
     asyncio.run(main())
@@ -169,3 +360,5 @@ except Exception:
 except KeyboardInterrupt:
     logger.debug("Received keyboard interrupt.")
     sys.exit(1)
+except asyncio.CancelledError:
+    logger.debug("Received SIGTERM.")
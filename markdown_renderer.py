@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+r"""markdown_renderer.py.
+
+This file implements the conversion of message text to HTML
+- one Markdown instance is reused for all messages instead of building a
+  new one, with its extensions, per call of markdown.markdown()
+- rendered bodies are kept in an LRU, so static replies like help, info
+  and the alias list are converted only once
+- text without any Markdown syntax is wrapped in paragraphs directly,
+  without running the Markdown engine at all
+
+"""
+
+import logging
+import re
+
+from cachetools import LRUCache
+from markdown import Markdown
+
+logger = logging.getLogger(__name__)
+
+# characters that can start Markdown syntax or need HTML escaping
+_SYNTAX_CHARS = re.compile(r"[\\`*_\[\]{}<>&#!|~=+\-\t\r]")
+# line based syntax: indented code, ordered lists, hard line breaks
+_SYNTAX_LINES = re.compile(r"^[ ]|^\d+\.|  $", re.MULTILINE)
+# paragraphs are separated by blank lines
+_BLANK_LINES = re.compile(r"\n(?:[ ]*\n)+")
+
+
+def is_plain_text(text: str) -> bool:
+    """Whether text contains nothing Markdown would convert."""
+    return not (_SYNTAX_CHARS.search(text) or _SYNTAX_LINES.search(text))
+
+
+def render_plain_text(text: str) -> str:
+    """Render text for which is_plain_text() holds, like Markdown would."""
+    paragraphs = _BLANK_LINES.split(text.strip("\n"))
+    return "\n".join(f"<p>{p}</p>" for p in paragraphs if p.strip())
+
+
+class MarkdownRenderer(object):
+    """Convert Markdown to HTML with a reused engine and a cache."""
+
+    def __init__(self, cache_size: int = 512, max_cached_length: int = 65536):
+        """Initialize.
+
+        Arguments:
+        ---------
+            cache_size (int): number of rendered messages kept
+            max_cached_length (int): longer messages are not cached,
+                they are rarely sent twice
+
+        """
+        self._markdown = Markdown()
+        self._cache = LRUCache(maxsize=cache_size)
+        self.max_cached_length = max_cached_length
+
+    def render(self, text: str) -> str:
+        """Return the HTML of text."""
+        if is_plain_text(text):
+            return render_plain_text(text)
+        html = self._cache.get(text)
+        if html is None:
+            html = self._markdown.reset().convert(text)
+            if len(text) <= self.max_cached_length:
+                self._cache[text] = html
+        return html
+
+
+# shared by all messages, rendering happens on the event loop thread only
+renderer = MarkdownRenderer()
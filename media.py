@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+r"""media.py.
+
+This file implements the inspection and processing of media before it
+is sent
+- a file is read once, in a small pool of worker threads: its mime type,
+  image dimensions and hash all come from that one buffer, which is then
+  uploaded as is
+- thumbnails are rendered with Pillow in the same pool, so decoding a
+  large GIF does not stall the event loop; only small, static images are
+  their own thumbnail, animated ones always get a still of their first
+  frame
+
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, Union
+
+import magic
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# bounding box of thumbnails in pixel
+THUMBNAIL_SIZE = (800, 600)
+
+# static images that fit into THUMBNAIL_SIZE and are at most this many
+# bytes are used as their own thumbnail
+THUMBNAIL_MAX_BYTES = 256 * 1024
+
+# files up to this size are read into memory once and uploaded from
+# there, larger ones are sniffed from their head and streamed from disk
+MAX_IN_MEMORY = 64 * 1024 * 1024
+
+# bytes libmagic needs to tell the type of a file
+SNIFF_SIZE = 8192
+
+# Pillow releases the GIL while decoding and resizing, so threads are
+# enough to keep this work off the event loop
+_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="k9-media")
+
+
+class MediaInfo(object):
+    """Everything needed to upload and announce a file."""
+
+    def __init__(self, path: str, size: int, mimetype: str, digest: str,
+                 data: Optional[bytes] = None, width: Optional[int] = None,
+                 height: Optional[int] = None, animated: bool = False):
+        """Initialize.
+
+        Arguments:
+        ---------
+            path (str): file name/path
+            size (int): size in bytes
+            mimetype (str): mime type, e.g. "image/jpeg"
+            digest (str): SHA-256 hex digest of the content
+            data (bytes): the content, None if the file is too large to be
+                kept in memory
+            width (int): width in pixel for images, else None
+            height (int): height in pixel for images, else None
+            animated (bool): whether the image has more than one frame
+
+        """
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.size = size
+        self.mimetype = mimetype
+        self.digest = digest
+        self.data = data
+        self.width = width
+        self.height = height
+        self.animated = animated
+
+    def is_own_thumbnail(self) -> bool:
+        """Whether the image is small and static enough to be its thumbnail.
+
+        Anything else, e.g. a multi-MB GIF of a few hundred pixels, gets a
+        rendered thumbnail, so viewers don't download the whole file for
+        the preview.
+        """
+        return (not self.animated
+                and self.size <= THUMBNAIL_MAX_BYTES
+                and self.width is not None
+                and self.width <= THUMBNAIL_SIZE[0]
+                and self.height <= THUMBNAIL_SIZE[1])
+
+
+async def inspect_media(path: str, image: bool = False) -> Optional[MediaInfo]:
+    """Read a file once in the worker pool and describe it.
+
+    Returns None if path is not a file.
+
+    Arguments:
+    ---------
+        path (str): file name/path
+        image (bool): whether to also read the dimensions of an image
+
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pool, _inspect, path, image)
+
+
+def _inspect(path: str, image: bool) -> Optional[MediaInfo]:
+    if not os.path.isfile(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= MAX_IN_MEMORY:
+            data = f.read()
+            head = data[:SNIFF_SIZE]
+            digest.update(data)
+        else:
+            data = None
+            head = f.read(SNIFF_SIZE)
+            digest.update(head)
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    mimetype = magic.from_buffer(head, mime=True)
+    info = MediaInfo(path, size, mimetype, digest.hexdigest(), data)
+    if image and mimetype.startswith("image/"):
+        with Image.open(io.BytesIO(data) if data is not None else path) as im:
+            info.width, info.height = im.size
+            info.animated = getattr(im, "is_animated", False)
+    return info
+
+
+class Thumbnail(object):
+    """A rendered thumbnail."""
+
+    def __init__(self, data: bytes, mimetype: str, width: int, height: int):
+        """Initialize.
+
+        Arguments:
+        ---------
+            data (bytes): encoded image
+            mimetype (str): mime type of data, image/jpeg or image/png
+            width (int): width in pixel
+            height (int): height in pixel
+
+        """
+        self.data = data
+        self.mimetype = mimetype
+        self.width = width
+        self.height = height
+
+
+async def make_thumbnail(source: Union[str, bytes],
+                         size: Tuple[int, int] = THUMBNAIL_SIZE
+                         ) -> Thumbnail:
+    """Render a thumbnail of an image in the worker pool.
+
+    The thumbnail is a still, the first frame of an animated image. An
+    image smaller than size keeps its dimensions.
+
+    Arguments:
+    ---------
+        source (str or bytes): file name/path or content of the image
+        size (tuple): (width, height) bounding box of the thumbnail
+
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pool, _render_thumbnail, source, size)
+
+
+def _render_thumbnail(source: Union[str, bytes],
+                      size: Tuple[int, int]) -> Thumbnail:
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    with Image.open(source) as im:
+        # animated images: the first frame is shown as preview
+        im.seek(0)
+        transparent = (im.mode in ("RGBA", "LA")
+                       or (im.mode == "P" and "transparency" in im.info))
+        frame = im.convert("RGBA" if transparent else "RGB")
+    frame.thumbnail(size)
+    buf = io.BytesIO()
+    if transparent:
+        frame.save(buf, format="PNG", optimize=True)
+        mimetype = "image/png"
+    else:
+        frame.save(buf, format="JPEG", quality=80)
+        mimetype = "image/jpeg"
+    return Thumbnail(buf.getvalue(), mimetype, frame.width, frame.height)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+r"""metrics.py.
+
+This file implements the metrics of the bot
+- counters, gauges and histograms that the other modules update as they
+  go; updating one is a dict lookup and an addition, no I/O
+- an optional HTTP endpoint on a local port that serves all of them in
+  the Prometheus text format, for scraping and alerting
+
+"""
+
+import abc
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# all metrics, in the order they are rendered
+REGISTRY = []
+
+# bucket bounds in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SCRIPT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SYNC_BUCKETS = (0.1, 0.5, 1, 5, 10, 20, 30, 35, 45, 60, 120)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return (str(value).replace("\\", r"\\").replace("\n", r"\n")
+            .replace('"', r"\""))
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"'
+                     for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(abc.ABC):
+    """Base of all metrics: name, help text and label names."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        REGISTRY.append(self)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    @abc.abstractmethod
+    def _samples(self) -> List[str]:
+        """Return the sample lines of the metric."""
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. the number of events received."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        """Add amount to the counter of the given label values."""
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, labels)} "
+                f"{_format_value(value)}"
+                for labels, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    """A value that is read when the metrics are rendered."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple, float] = {}
+        self._functions: Dict[Tuple, Callable[[], float]] = {}
+
+    def set(self, value: float, *labels):
+        """Set the gauge of the given label values."""
+        self._values[labels] = value
+
+    def set_function(self, function: Callable[[], float], *labels):
+        """Read the gauge of the given label values from function()."""
+        self._functions[labels] = function
+
+    def _samples(self) -> List[str]:
+        values = dict(self._values)
+        for labels, function in self._functions.items():
+            try:
+                values[labels] = function()
+            except Exception:
+                logger.exception(f"Reading the gauge {self.name} failed")
+        return [f"{self.name}{_format_labels(self.label_names, labels)} "
+                f"{_format_value(value)}"
+                for labels, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. latencies in seconds."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket..., count above all, sum]
+        self._values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, *labels):
+        """Count value for the given label values."""
+        counts = self._values.get(labels)
+        if counts is None:
+            counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the seconds the with block took."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, *labels)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        names = self.label_names + ("le",)
+        for labels, counts in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket"
+                    f"{_format_labels(names, labels + (_format_value(bound),))} "
+                    f"{cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} "
+                         f"{_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """Return all metrics in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+EVENTS = Counter(
+    "k9_events_total", "Events received from the homeserver.", ["type"])
+COMMANDS = Counter(
+    "k9_commands_total", "Commands dispatched.", ["alias"])
+SCRIPT_SECONDS = Histogram(
+    "k9_script_duration_seconds", "Run time of scripts.", ["script"],
+    buckets=SCRIPT_BUCKETS)
+REQUEST_SECONDS = Histogram(
+    "k9_matrix_request_duration_seconds",
+    "Duration of room_send and upload requests.", ["request"])
+SYNC_SECONDS = Histogram(
+    "k9_sync_duration_seconds", "Round-trip time of sync requests.",
+    buckets=SYNC_BUCKETS)
+LAST_SYNC = Gauge(
+    "k9_last_successful_sync_timestamp_seconds",
+    "Unix time of the last successful sync.")
+RUNNING_SCRIPTS = Gauge(
+    "k9_running_scripts", "Scripts running right now.")
+QUEUE_DEPTH = Gauge(
+    "k9_queue_depth", "Items waiting in a queue.", ["queue"])
+CONNECTED = Gauge(
+    "k9_connected", "1 while the homeserver is reachable, else 0.")
+RECONNECTS = Counter(
+    "k9_reconnects_total", "Connections re-established after a failure.")
+DISCONNECTED_SECONDS = Counter(
+    "k9_disconnected_seconds_total",
+    "Seconds the homeserver was unreachable, counted on reconnect.")
+LOOP_LAG = Histogram(
+    "k9_event_loop_lag_seconds",
+    "How late the event loop ran a timer that was due.")
+SLOW_CALLBACKS = Counter(
+    "k9_slow_callbacks_total",
+    "Callbacks that blocked the event loop longer than the threshold.",
+    ["coroutine"])
+
+
+def observe_sync(client):
+    """Time every sync of client and remember the last successful one.
+
+    Wraps the sync method of this client instance, sync_forever() and
+    every other caller go through the wrapper.
+    """
+    # imported here, so the metrics above can be used without nio
+    from nio import SyncResponse
+
+    sync = client.sync
+
+    async def timed_sync(*args, **kwargs):
+        with SYNC_SECONDS.time():
+            response = await sync(*args, **kwargs)
+        if isinstance(response, SyncResponse):
+            LAST_SYNC.set(time.time())
+        return response
+
+    client.sync = timed_sync
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    """Serve the metrics on http://host:port/metrics.
+
+    Returns the runner, call its cleanup() to stop the server.
+    """
+
+    async def handle(request):
+        return web.Response(body=render().encode(),
+                            headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
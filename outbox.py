@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+r"""outbox.py.
+
+This file implements the queue all outgoing room messages go through
+- every room has its own queue, messages to a room leave in the order they
+  were sent, rooms are served in parallel
+- token buckets keep each room and the whole account within a send budget
+- when the homeserver still answers with M_LIMIT_EXCEEDED, the account
+  pauses for retry_after_ms and the message is sent again, it is never
+  dropped; media uploads are retried the same way
+- the small text parts of one output that pile up for a room while it
+  waits for its budget are merged into one event, messages of different
+  outputs never are
+
+"""
+
+import asyncio
+import io
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Union
+
+import aiofiles
+from nio import RoomSendError, UploadError
+
+from metrics import REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# status codes of a rate limited request, nio reports either
+LIMIT_EXCEEDED = ("M_LIMIT_EXCEEDED", 429)
+
+# pause if a rate limited response comes without retry_after_ms
+DEFAULT_RETRY_AFTER_MS = 5000
+
+# separators between the messages merged into one event
+MERGE_BODY_SEPARATOR = "\n\n"
+MERGE_HTML_SEPARATOR = "\n"
+
+
+class _Bucket(object):
+    """Token bucket: rate tokens per second, up to burst tokens saved."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available, 0 if there is one now."""
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+        else:
+            # no limit
+            self.tokens = self.burst
+        self.updated = now
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        """Hand out no tokens for the given time."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            wait = self.wait_time()
+            if wait <= 0:
+                self.take()
+                return
+            await asyncio.sleep(wait)
+
+
+class _Outgoing(object):
+    """A queued message and the futures of everyone waiting for it."""
+
+    def __init__(self, client, message_type: str, content: dict,
+                 group, ignore_unverified_devices: bool):
+        self.client = client
+        self.message_type = message_type
+        self.content = content
+        # parts of the same output share a group, None for a single message
+        self.group = group
+        self.ignore_unverified_devices = ignore_unverified_devices
+        self.futures: List[asyncio.Future] = [
+            asyncio.get_running_loop().create_future()]
+
+    def can_merge(self, other: "_Outgoing", limit: int) -> bool:
+        """Whether other can be appended to this message."""
+        if self.group is None or self.group is not other.group:
+            return False
+        if (self.client is not other.client
+                or self.message_type != other.message_type
+                or self.ignore_unverified_devices
+                != other.ignore_unverified_devices):
+            return False
+        a, b = self.content, other.content
+        if a.keys() != b.keys() or not a.keys() <= {
+                "msgtype", "body", "format", "formatted_body"}:
+            return False
+        if a.get("msgtype") != b.get("msgtype") or a.get(
+                "format") != b.get("format"):
+            return False
+        size = len(a["body"]) + len(MERGE_BODY_SEPARATOR) + len(b["body"])
+        return size <= limit
+
+    def merge(self, other: "_Outgoing"):
+        content = dict(self.content)
+        content["body"] += MERGE_BODY_SEPARATOR + other.content["body"]
+        if "formatted_body" in content:
+            content["formatted_body"] += (
+                MERGE_HTML_SEPARATOR + other.content["formatted_body"])
+        self.content = content
+        self.futures.extend(other.futures)
+
+
+class Outbox(object):
+    """Send room messages within the rate limits of the homeserver."""
+
+    def __init__(self, room_rate: float = 1, room_burst: int = 5,
+                 account_rate: float = 5, account_burst: int = 20,
+                 merge_limit: int = 4000):
+        """Initialize.
+
+        Arguments:
+        ---------
+            room_rate (float): messages per second to a single room,
+                0 for no limit
+            room_burst (int): messages a room may receive at once after
+                it was quiet
+            account_rate (float): messages per second over all rooms,
+                0 for no limit
+            account_burst (int): messages that may be sent at once over
+                all rooms after the account was quiet
+            merge_limit (int): characters up to which queued mergeable
+                messages to the same room are merged, 0 to never merge
+
+        """
+        self.configure(room_rate, room_burst, account_rate, account_burst,
+                       merge_limit)
+        # server side limits are per account, a pause stops every room
+        self._account_lock = asyncio.Lock()
+        self._queues: Dict[str, Deque[_Outgoing]] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        # statistics
+        self.sent = 0
+        self.merged = 0
+        self.rate_limited = 0
+
+    def configure(self, room_rate: float, room_burst: int,
+                  account_rate: float, account_burst: int, merge_limit: int):
+        """Set new budgets, see __init__() for the arguments."""
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.merge_limit = merge_limit
+        self._account = _Bucket(account_rate, account_burst)
+        self._rooms: Dict[str, _Bucket] = {}
+
+    async def send(self, client, room_id: str, message_type: str,
+                   content: dict, ignore_unverified_devices: bool = False):
+        """Queue a message and wait until it was sent.
+
+        Arguments:
+        ---------
+            client (nio.AsyncClient): The client to communicate with Matrix
+            room_id (str): The ID of the room to send the message to
+            message_type (str): event type, e.g. "m.room.message"
+            content (dict): content of the event
+            ignore_unverified_devices (bool): passed on to room_send()
+
+        Returns the response of room_send(). Exceptions of room_send(),
+        e.g. SendRetryError, are raised to the caller.
+
+        """
+        return await self._queue(room_id, _Outgoing(
+            client, message_type, content, None, ignore_unverified_devices))
+
+    def send_parts(self, client, room_id: str, message_type: str,
+                   contents: List[dict],
+                   ignore_unverified_devices: bool = False
+                   ) -> List[asyncio.Future]:
+        """Queue the parts of one output, they may be merged with each other.
+
+        Parts that are waiting for the budget together go out as one event
+        if they are plain text and fit into the merge limit. They are never
+        merged with other messages.
+
+        Arguments are the same as for send(), with a list of contents.
+
+        Returns a future per part with its response of room_send(). Merged
+        parts all get the response of the event they ended up in.
+
+        """
+        group = object()
+        return [
+            self._queue(room_id, _Outgoing(
+                client, message_type, content, group,
+                ignore_unverified_devices))
+            for content in contents]
+
+    async def upload(self, client, data: Union[bytes, str], **kwargs):
+        """Upload media, pausing and retrying while it is rate limited.
+
+        Uploads don't take from the send budget, but like messages they
+        wait out the pause after M_LIMIT_EXCEEDED and are never dropped
+        for it.
+
+        Arguments:
+        ---------
+            client (nio.AsyncClient): The client to communicate with Matrix
+            data (bytes or str): the content, or the path of a file that is
+                read again for every attempt
+            kwargs: passed on to AsyncClient.upload()
+
+        Returns the (response, decryption keys) tuple of upload().
+
+        """
+        while True:
+            if isinstance(data, bytes):
+                response, keys = await client.upload(
+                    io.BytesIO(data), **kwargs)
+            else:
+                async with aiofiles.open(data, "rb") as f:
+                    response, keys = await client.upload(f, **kwargs)
+            if not (isinstance(response, UploadError)
+                    and response.status_code in LIMIT_EXCEEDED):
+                return response, keys
+            await self._back_off(response, "uploading media")
+
+    def _queue(self, room_id: str, item: _Outgoing) -> asyncio.Future:
+        """Queue item and return the future of its response."""
+        queue = self._queues.get(room_id)
+        if queue is None:
+            queue = self._queues[room_id] = deque()
+        queue.append(item)
+        if room_id not in self._workers:
+            self._workers[room_id] = asyncio.ensure_future(
+                self._work(room_id, queue))
+        return item.futures[0]
+
+    def queue_depth(self) -> int:
+        """Return the number of messages waiting over all rooms."""
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def close(self):
+        """Cancel all workers, e.g. on shutdown."""
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _work(self, room_id: str, queue: Deque[_Outgoing]):
+        bucket = self._rooms.get(room_id)
+        if bucket is None:
+            bucket = self._rooms[room_id] = _Bucket(
+                self.room_rate, self.room_burst)
+        try:
+            while queue:
+                await bucket.acquire()
+                async with self._account_lock:
+                    await self._account.acquire()
+                # Messages queued while waiting for the budget go out
+                # together
+                item = queue.popleft()
+                while queue and item.can_merge(queue[0], self.merge_limit):
+                    item.merge(queue.popleft())
+                    self.merged += 1
+                await self._deliver(room_id, item)
+        finally:
+            # Nothing is awaited between the empty check and here, so no
+            # message can be queued without a worker.
+            del self._workers[room_id]
+            del self._queues[room_id]
+            for item in queue:
+                for future in item.futures:
+                    future.cancel()
+
+    async def _deliver(self, room_id: str, item: _Outgoing):
+        while True:
+            try:
+                with REQUEST_SECONDS.time("room_send"):
+                    response = await item.client.room_send(
+                        room_id, item.message_type, item.content,
+                        ignore_unverified_devices=(
+                            item.ignore_unverified_devices))
+            except asyncio.CancelledError:
+                for future in item.futures:
+                    future.cancel()
+                raise
+            except Exception as e:
+                for future in item.futures:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            if (isinstance(response, RoomSendError)
+                    and response.status_code in LIMIT_EXCEEDED):
+                await self._back_off(response, f"sending to {room_id}")
+                continue
+            self.sent += 1
+            for future in item.futures:
+                if not future.done():
+                    future.set_result(response)
+            return
+
+    async def _back_off(self, response, what: str):
+        """Pause the account for the retry_after_ms of response."""
+        retry_after = (response.retry_after_ms
+                       or DEFAULT_RETRY_AFTER_MS) / 1000
+        self.rate_limited += 1
+        logger.warning(
+            f"Rate limited {what}, retrying in {retry_after:.1f}s.")
+        self._account.pause(retry_after)
+        async with self._account_lock:
+            await self._account.acquire()
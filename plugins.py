@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+r"""plugins.py.
+
+This file implements the loading of script plugins
+- a Python script in the scripts dir becomes a plugin by defining
+  `async def k9_main(args: list, env: dict) -> str`
+- plugins run inside the bot's event loop instead of a fresh interpreter,
+  which saves the interpreter start-up and the imports on every call
+- scripts without that entry point keep running as subprocesses
+
+A plugin gets the same arguments and environment a subprocess would get
+and returns what it would have printed. K9_SCRIPT in env holds the name
+the script was called by, as argv[0] would. Plugins must not block the
+event loop.
+
+"""
+
+import asyncio
+import importlib.util
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ENTRY_POINT = "k9_main"
+
+
+class PluginLoader(object):
+    """Import script plugins on first use and cache them by mtime."""
+
+    def __init__(self, scripts_dir: str):
+        """Initialize.
+
+        Arguments:
+        ---------
+            scripts_dir (str): directory holding the scripts
+
+        """
+        self.scripts_dir = scripts_dir
+        # script name -> (mtime of the file, entry point or None)
+        self._cache: Dict[str, Tuple[int, Optional[Callable]]] = {}
+
+    async def get(self, script: str) -> Optional[Callable[..., Awaitable[str]]]:
+        """Return the entry point of a script, None if it is no plugin.
+
+        The module is imported in a worker thread the first time and
+        again whenever the file changed.
+
+        Arguments:
+        ---------
+            script (str): file name of the script in the scripts dir
+
+        """
+        if not script.endswith(".py"):
+            return None
+        path = os.path.join(self.scripts_dir, script)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        cached = self._cache.get(script)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        loop = asyncio.get_running_loop()
+        entry = await loop.run_in_executor(None, self._load, script, path)
+        self._cache[script] = (mtime, entry)
+        return entry
+
+    def _load(self, script: str, path: str) -> Optional[Callable]:
+        # Only import files that declare the entry point, importing any
+        # other script would run code that expects to be a subprocess.
+        try:
+            with open(path, encoding="utf-8") as f:
+                if f"async def {ENTRY_POINT}(" not in f.read():
+                    return None
+        except (OSError, UnicodeDecodeError):
+            return None
+
+        module_name = "k9_plugin_" + os.path.splitext(script)[0]
+        try:
+            spec = importlib.util.spec_from_file_location(module_name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        except Exception:
+            logger.exception(
+                f"Importing plugin {script} failed, running it as a "
+                "subprocess instead.")
+            return None
+
+        entry = getattr(module, ENTRY_POINT, None)
+        if not asyncio.iscoroutinefunction(entry):
+            logger.warning(
+                f"{ENTRY_POINT} of {script} is not a coroutine function, "
+                "running it as a subprocess instead.")
+            return None
+        logger.info(f"Loaded {script} as in-process plugin.")
+        return entry
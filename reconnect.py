@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+r"""reconnect.py.
+
+This file implements the reconnect supervisor of the bot
+- a connection to the homeserver is run until it fails; connection
+  errors and timeouts are caught and the connection is started again
+- between two attempts it waits without blocking the event loop, for a
+  capped exponential backoff with jitter, so a restarted homeserver is
+  not hit by all its clients at the same moment
+- it counts reconnects and the seconds spent disconnected and exports
+  both as metrics (see metrics.py)
+
+"""
+
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import ClientConnectionError
+
+from metrics import CONNECTED, DISCONNECTED_SECONDS, RECONNECTS
+
+logger = logging.getLogger(__name__)
+
+# errors that mean the homeserver could not be reached
+CONNECTION_ERRORS = (ClientConnectionError, asyncio.TimeoutError)
+
+
+class Backoff(object):
+    """Capped exponential backoff with jitter."""
+
+    def __init__(self, initial: float = 1, maximum: float = 60,
+                 factor: float = 2):
+        """Initialize.
+
+        Arguments:
+        ---------
+            initial (float): seconds to wait after the first failure
+            maximum (float): seconds to wait at most
+            factor (float): growth of the delay with every failure
+
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.failures = 0
+
+    def next_delay(self) -> float:
+        """Count a failure and return the seconds to wait before retrying.
+
+        The delay is drawn between half and all of the capped exponential
+        delay, so clients that failed together retry spread out.
+        """
+        ceiling = min(self.maximum,
+                      self.initial * self.factor ** min(self.failures, 64))
+        self.failures += 1
+        return random.uniform(ceiling / 2, ceiling)
+
+    def reset(self):
+        """Start over with the initial delay."""
+        self.failures = 0
+
+
+class ReconnectSupervisor(object):
+    """Run a connection to the homeserver and restart it when it fails."""
+
+    def __init__(self, initial_delay: float = 1, max_delay: float = 60):
+        """Initialize.
+
+        Arguments:
+        ---------
+            initial_delay (float): seconds to wait after the first failure
+            max_delay (float): seconds to wait at most between two attempts
+
+        """
+        self.backoff = Backoff(initial_delay, max_delay)
+        self.reconnects = 0
+        self.downtime = 0.0
+        # not connected until the homeserver answered for the first time
+        self._disconnected_at: Optional[float] = time.monotonic()
+        self._ever_connected = False
+        CONNECTED.set_function(lambda: 0 if self._disconnected_at else 1)
+
+    @property
+    def is_reconnect(self) -> bool:
+        """Whether a connection was established before."""
+        return self._ever_connected
+
+    def connected(self):
+        """Report that the connection is up again, e.g. after a sync."""
+        if self._disconnected_at is not None and self._ever_connected:
+            down = time.monotonic() - self._disconnected_at
+            self.downtime += down
+            self.reconnects += 1
+            DISCONNECTED_SECONDS.inc(amount=down)
+            RECONNECTS.inc()
+            logger.info(f"Reconnected after {down:.1f}s "
+                        f"({self.reconnects} reconnects so far).")
+        self._disconnected_at = None
+        self._ever_connected = True
+        self.backoff.reset()
+
+    async def run(self, connect: Callable[[], Awaitable]):
+        """Run connect() until it returns, restarting it on connection errors.
+
+        connect() should call connected() once the homeserver answered.
+
+        Returns what connect() returned.
+        """
+        while True:
+            try:
+                return await connect()
+            except CONNECTION_ERRORS as e:
+                if self._disconnected_at is None:
+                    self._disconnected_at = time.monotonic()
+                delay = self.backoff.next_delay()
+                logger.warning(
+                    "Unable to connect to homeserver "
+                    f"({type(e).__name__}: {e}), retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+r"""result_cache.py.
+
+This file implements the cache of script results
+- results of scripts with a `cache_ttl` in aliases.yaml are reused until
+  the TTL has passed instead of running the script again
+- the key is executor.command_key(): the script, its normalised
+  arguments and its environment without the room specific variables,
+  so all rooms share an entry
+- entries live in an in-memory LRU and in the Storage, so they survive
+  a restart
+
+"""
+
+import logging
+import time
+from typing import Optional, Tuple
+
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache(object):
+    """Two level TTL cache of script output."""
+
+    def __init__(self, store, maxsize: int = 256):
+        """Initialize.
+
+        Arguments:
+        ---------
+            store (Storage): Bot storage, None to keep results in memory only
+            maxsize (int): number of results kept in memory
+
+        """
+        self.store = store
+        self._memory = LRUCache(maxsize=maxsize)
+
+    async def purge(self):
+        """Delete the expired results from the Storage, e.g. at start-up."""
+        if self.store is not None:
+            await self.store.purge_cached_results(time.time())
+
+    async def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """Return (stdout, stderr) of a fresh result or None."""
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is None and self.store is not None:
+            entry = await self.store.get_cached_result(key)
+            if entry is not None:
+                self._memory[key] = entry
+        if entry is None:
+            return None
+        expires, stdout, stderr = entry
+        if expires <= now:
+            self._memory.pop(key, None)
+            return None
+        return stdout, stderr
+
+    async def put(self, key: str, ttl: float, stdout: str, stderr: str):
+        """Keep a result for ttl seconds."""
+        entry = (time.time() + ttl, stdout, stderr)
+        self._memory[key] = entry
+        if self.store is not None:
+            await self.store.put_cached_result(key, *entry)
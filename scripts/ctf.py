@@ -2,7 +2,7 @@
 
 import os
 import sys
-from dotenv import load_dotenv
+from dotenv import load_dotenv, dotenv_values
 import click
 from aiohttp import ClientSession
 import logging
@@ -51,8 +51,25 @@ async def ctf(req_type: str, teamid: str) -> str:
   return output
 
 
+REQ_TYPES = ['teams', 'events', 'results', 'top', 'help']
+
+
+async def k9_main(args: list, env: dict) -> str:
+  """Entry point for running in-process inside the bot."""
+  args = [arg for arg in args if arg not in ('-v', '--verbose')]
+  req_type = args[0] if args else "teams"
+  if req_type == 'help' or req_type not in REQ_TYPES or len(args) > 1:
+    return main.get_help(click.Context(main, info_name="ctf"))
+  config = "{}/config.rc".format(os.path.abspath(os.path.dirname(__file__)))
+  # reading config.rc must not block the bot
+  loop = asyncio.get_running_loop()
+  values = await loop.run_in_executor(None, dotenv_values, config)
+  teamid = {**values, **env}.get("CTF_TEAMID", "translate")
+  return await ctf(req_type, teamid)
+
+
 @click.command()
-@click.argument('type', default="teams", type=click.Choice(['teams', 'events', 'results', 'top', 'help']))
+@click.argument('type', default="teams", type=click.Choice(REQ_TYPES))
 @click.option('--verbose', '-v', is_flag=True, help="Print more output.")
 def main(type, verbose):
   if type == 'help':
@@ -2,7 +2,7 @@
 
 import os
 import sys
-from dotenv import load_dotenv
+from dotenv import load_dotenv, dotenv_values
 import click
 from aiohttp import ClientSession
 import logging
@@ -10,7 +10,6 @@ import asyncio
 import aiofiles
 
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
@@ -36,19 +35,41 @@ async def giphy(search_term: str, endpoint: str, api_key: str, cache_dir: str, i
   return image_path
 
 
+def settings(env) -> tuple:
+  endpoint = env.get("GIPHY_ENDPOINT", "translate")
+  cache_dir = env.get("GIPHY_CACHE", "/tmp/giphycache")
+  api_key = env.get("GIPHY_API_KEY", "")
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
+  return endpoint, api_key, cache_dir
+
+
+def plugin_settings(env: dict) -> tuple:
+  """Settings from config.rc and env, blocks on file access."""
+  config = "{}/config.rc".format(os.path.abspath(os.path.dirname(__file__)))
+  return settings({**dotenv_values(config), **env})
+
+
+async def k9_main(args: list, env: dict) -> str:
+  """Entry point for running in-process inside the bot."""
+  image = not env.get("K9_SCRIPT", "").startswith('giphy')
+  # reading config.rc and creating the cache dir must not block the bot
+  loop = asyncio.get_running_loop()
+  endpoint, api_key, cache_dir = await loop.run_in_executor(
+    None, plugin_settings, env)
+  return await giphy(" ".join(args), endpoint, api_key, cache_dir, image)
+
+
 @click.command()
 @click.argument('search')
 @click.option('--image', is_flag=True, default=True)
 def main(search, image):
+  logging.basicConfig(level=logging.INFO)
   image = False if os.path.basename(sys.argv[0]).startswith('giphy') else image
   config = "{}/config.rc".format(os.path.abspath(os.path.dirname(sys.argv[0])))
   load_dotenv(dotenv_path=config)
   logger.info(image)
-  endpoint = os.getenv("GIPHY_ENDPOINT", default="translate")
-  cache_dir = os.getenv("GIPHY_CACHE", default="/tmp/giphycache")
-  api_key = os.getenv("GIPHY_API_KEY", default="")
-  if not os.path.exists(cache_dir):
-    os.makedirs(cache_dir)
+  endpoint, api_key, cache_dir = settings(os.environ)
   loop = asyncio.get_event_loop()
   output = loop.run_until_complete(giphy(search, endpoint, api_key, cache_dir, image))
   print(output)
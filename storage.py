@@ -1,48 +1,419 @@
+import asyncio
 import sqlite3
-import os.path
 import logging
-
-latest_db_version = 0
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+# Schema migrations, applied in order to bring a database to the latest
+# version. Every migration runs in its own transaction together with the
+# update of PRAGMA user_version, so an interrupted upgrade resumes at the
+# step that failed. Append new migrations, never change released ones.
+MIGRATIONS = [
+    (1, "sync token and script result cache", [
+        "CREATE TABLE IF NOT EXISTS sync_token ("
+        "dedupe_id INTEGER PRIMARY KEY, "
+        "token TEXT NOT NULL"
+        ")",
+        "CREATE TABLE IF NOT EXISTS command_cache ("
+        "key TEXT PRIMARY KEY, "
+        "expires REAL NOT NULL, "
+        "stdout TEXT NOT NULL, "
+        "stderr TEXT NOT NULL"
+        ")",
+    ]),
+    (2, "uploaded media", [
+        "CREATE TABLE IF NOT EXISTS media_cache ("
+        "hash TEXT NOT NULL, "
+        "size INTEGER NOT NULL, "
+        "mimetype TEXT NOT NULL, "
+        "content_uri TEXT NOT NULL, "
+        "PRIMARY KEY (hash, size, mimetype)"
+        ")",
+    ]),
+    (3, "uploaded thumbnails", [
+        "CREATE TABLE IF NOT EXISTS thumbnail_cache ("
+        "hash TEXT NOT NULL, "
+        "size INTEGER NOT NULL, "
+        "mimetype TEXT NOT NULL, "
+        "content_uri TEXT NOT NULL, "
+        "thumbnail_mimetype TEXT NOT NULL, "
+        "thumbnail_size INTEGER NOT NULL, "
+        "w INTEGER NOT NULL, "
+        "h INTEGER NOT NULL, "
+        "PRIMARY KEY (hash, size, mimetype)"
+        ")",
+    ]),
+    (4, "expiry index of the script result cache", [
+        "CREATE INDEX IF NOT EXISTS command_cache_expires "
+        "ON command_cache (expires)",
+    ]),
+    (5, "command history", [
+        "CREATE TABLE IF NOT EXISTS command_history ("
+        "id INTEGER PRIMARY KEY, "
+        "ts REAL NOT NULL, "
+        "alias TEXT NOT NULL, "
+        "script TEXT NOT NULL, "
+        "room_id TEXT NOT NULL, "
+        "sender TEXT NOT NULL, "
+        "queue_wait REAL NOT NULL, "
+        "run_time REAL NOT NULL, "
+        "exit_code INTEGER, "
+        "output_bytes INTEGER"
+        ")",
+        "CREATE INDEX IF NOT EXISTS command_history_ts "
+        "ON command_history (ts)",
+        # older history, compacted to one row per day and alias
+        "CREATE TABLE IF NOT EXISTS command_stats ("
+        "day TEXT NOT NULL, "
+        "alias TEXT NOT NULL, "
+        "script TEXT NOT NULL, "
+        "calls INTEGER NOT NULL, "
+        "errors INTEGER NOT NULL, "
+        "users INTEGER NOT NULL, "
+        "queue_wait REAL NOT NULL, "
+        "run_time REAL NOT NULL, "
+        "max_run_time REAL NOT NULL, "
+        "output_bytes INTEGER NOT NULL, "
+        "PRIMARY KEY (day, alias)"
+        ")",
+    ]),
+    (6, "sync filter IDs", [
+        "CREATE TABLE IF NOT EXISTS sync_filter ("
+        "user_id TEXT NOT NULL, "
+        "digest TEXT NOT NULL, "
+        "filter_id TEXT NOT NULL, "
+        "PRIMARY KEY (user_id, digest)"
+        ")",
+    ]),
+]
+
+latest_db_version = MIGRATIONS[-1][0]
+
+# Applied to every connection. With WAL, readers never wait for the writer
+# and a commit only appends to the log; synchronous=NORMAL skips the fsync
+# per commit, a crash may lose the last commits but never corrupts the db.
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA wal_autocheckpoint = 1000",
+]
+
 
 class Storage(object):
-    def __init__(self, db_path):
+    def __init__(self, db_path, commit_interval=0.05, commit_batch=100):
         """Setup the database
 
-        Runs an initial setup or migrations depending on whether a database file has already
-        been created
+        Opens the database in a thread of its own and brings its schema to
+        the latest version. All queries run in that thread, the async
+        methods below never block the event loop.
+
+        Writes are not committed one by one: they are collected and
+        committed together commit_interval seconds after the first one, or
+        as soon as commit_batch writes are pending. Reads use the same
+        connection, so they always see pending writes.
 
         Args:
             db_path (str): The name of the database file
+            commit_interval (float): Seconds a write may wait for its commit
+            commit_batch (int): Pending writes that trigger a commit at once
         """
         self.db_path = db_path
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.conn = None
+        self._pending = 0
+        self._commit_handle = None
+        # one thread owns the connection, which also serializes all queries
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="k9-db")
+        # during start-up waiting is fine, nothing else runs yet
+        self._thread.submit(self._open).result()
+
+    def _open(self):
+        """Connect, tune and migrate the database, in the DB thread"""
+        self.conn = sqlite3.connect(self.db_path, isolation_level=None)
+        for pragma in PRAGMAS:
+            self.conn.execute(pragma)
+        self._run_migrations()
+
+    def _run_migrations(self):
+        """Execute database migrations"""
+        db_version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if db_version == 0:
+            logger.info("Performing initial database setup...")
+        for version, description, statements in MIGRATIONS:
+            if version <= db_version:
+                continue
+            logger.info(f"Migrating database to version {version} ({description})...")
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for statement in statements:
+                    self.conn.execute(statement)
+                self.conn.execute(f"PRAGMA user_version = {version}")
+                self.conn.execute("COMMIT")
+            except sqlite3.Error:
+                self.conn.execute("ROLLBACK")
+                raise
+        if db_version > latest_db_version:
+            logger.warning(f"Database version {db_version} is newer than this "
+                           f"bot's {latest_db_version}.")
+
+    async def _run(self, func, *args):
+        """Run func(*args) in the DB thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._thread, func, *args)
 
-        # Check if a database has already been connected
-        if os.path.isfile(self.db_path):
-            self._run_migrations()
+    async def _fetchone(self, sql, params=()):
+        return await self._run(lambda: self.conn.execute(sql, params).fetchone())
+
+    async def _write(self, sql, params=(), many=False):
+        """Execute a write, it is committed with the next batch
+
+        With many=True, params is a list of parameter tuples and sql is
+        executed for each of them.
+        """
+        await self._run(self._write_sync, sql, params, many)
+        if self._pending and self._commit_handle is None:
+            loop = asyncio.get_running_loop()
+            self._commit_handle = loop.call_later(
+                self.commit_interval,
+                lambda: asyncio.ensure_future(self.commit()))
+
+    def _write_sync(self, sql, params, many=False):
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        if many:
+            self._pending += self.conn.executemany(sql, params).rowcount
         else:
-            self._initial_setup()
+            self.conn.execute(sql, params)
+            self._pending += 1
+        if self._pending >= self.commit_batch:
+            self._commit_sync()
 
-    def _initial_setup(self):
-        """Initial setup of the database"""
-        logger.info("Performing initial database setup...")
+    def _commit_sync(self):
+        if self.conn.in_transaction:
+            self.conn.execute("COMMIT")
+        self._pending = 0
 
-        # Initialize a connection to the database
-        self.conn = sqlite3.connect(self.db_path)
-        self.cursor = self.conn.cursor()
+    async def commit(self):
+        """Commit all pending writes now"""
+        if self._commit_handle is not None:
+            self._commit_handle.cancel()
+            self._commit_handle = None
+        await self._run(self._commit_sync)
 
-        # Sync token table
-        self.cursor.execute("CREATE TABLE sync_token ("
-                            "dedupe_id INTEGER PRIMARY KEY, "
-                            "token TEXT NOT NULL"
-                            ")")
+    async def close(self):
+        """Commit pending writes and close the database"""
+        await self.commit()
+        await self._run(self.conn.close)
+        self._thread.shutdown()
 
-        logger.info("Database setup complete")
+    async def get_sync_token(self):
+        """Get the token of the last sync
 
-    def _run_migrations(self):
-        """Execute database migrations"""
-        # Initialize a connection to the database
-        self.conn = sqlite3.connect(self.db_path)
-        self.cursor = self.conn.cursor()
+        Returns:
+            str: The next_batch token of the last sync or None if the bot
+                never synced
+        """
+        row = await self._fetchone("SELECT token FROM sync_token WHERE dedupe_id = 1")
+        return row[0] if row else None
+
+    async def put_sync_token(self, token):
+        """Remember the token of the last sync
+
+        Args:
+            token (str): The next_batch token of the sync
+        """
+        await self._write("INSERT OR REPLACE INTO sync_token (dedupe_id, token) "
+                          "VALUES (1, ?)", (token,))
+
+    async def delete_sync_token(self):
+        """Forget the token of the last sync, e.g. after it was rejected"""
+        await self._write("DELETE FROM sync_token")
+
+    async def get_sync_filter(self, user_id, digest):
+        """Get the ID of an uploaded sync filter
+
+        Args:
+            user_id (str): The user the filter was uploaded for
+            digest (str): SHA-256 hex digest of the filter definition
+
+        Returns:
+            str: The filter ID or None if the filter was not uploaded yet
+        """
+        row = await self._fetchone("SELECT filter_id FROM sync_filter "
+                                   "WHERE user_id = ? AND digest = ?",
+                                   (user_id, digest))
+        return row[0] if row else None
+
+    async def put_sync_filter(self, user_id, digest, filter_id):
+        """Remember the ID of an uploaded sync filter
+
+        Args:
+            user_id (str): The user the filter was uploaded for
+            digest (str): SHA-256 hex digest of the filter definition
+            filter_id (str): The ID returned by the upload
+        """
+        await self._write("INSERT OR REPLACE INTO sync_filter "
+                          "(user_id, digest, filter_id) VALUES (?, ?, ?)",
+                          (user_id, digest, filter_id))
+
+    async def delete_sync_filters(self):
+        """Forget the IDs of all sync filters, e.g. after one was rejected"""
+        await self._write("DELETE FROM sync_filter")
+
+    async def get_thumbnail(self, digest, size, mimetype):
+        """Get the uploaded thumbnail of an image
+
+        Args:
+            digest (str): SHA-256 hex digest of the image
+            size (int): Size of the image in bytes
+            mimetype (str): Mime type of the image
+
+        Returns:
+            tuple: (content_uri, mimetype, size, w, h) of the thumbnail or
+                None if there is none yet
+        """
+        return await self._fetchone(
+            "SELECT content_uri, thumbnail_mimetype, thumbnail_size, w, h "
+            "FROM thumbnail_cache "
+            "WHERE hash = ? AND size = ? AND mimetype = ?",
+            (digest, size, mimetype))
+
+    async def put_thumbnail(self, digest, size, mimetype, thumbnail):
+        """Remember the uploaded thumbnail of an image
+
+        Args:
+            digest (str): SHA-256 hex digest of the image
+            size (int): Size of the image in bytes
+            mimetype (str): Mime type of the image
+            thumbnail (tuple): (content_uri, mimetype, size, w, h) of the
+                thumbnail
+        """
+        await self._write("INSERT OR REPLACE INTO thumbnail_cache "
+                          "(hash, size, mimetype, content_uri, thumbnail_mimetype, "
+                          "thumbnail_size, w, h) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                          (digest, size, mimetype) + tuple(thumbnail))
+
+    async def get_media_uri(self, digest, size, mimetype):
+        """Get the mxc:// URI of content that was uploaded before
+
+        Args:
+            digest (str): SHA-256 hex digest of the content
+            size (int): Size of the content in bytes
+            mimetype (str): Mime type the content was uploaded with
+
+        Returns:
+            str: The content URI or None if it was not uploaded yet
+        """
+        row = await self._fetchone("SELECT content_uri FROM media_cache "
+                                   "WHERE hash = ? AND size = ? AND mimetype = ?",
+                                   (digest, size, mimetype))
+        return row[0] if row else None
+
+    async def put_media_uri(self, digest, size, mimetype, content_uri):
+        """Remember the mxc:// URI of uploaded content
+
+        Args:
+            digest (str): SHA-256 hex digest of the content
+            size (int): Size of the content in bytes
+            mimetype (str): Mime type the content was uploaded with
+            content_uri (str): The URI returned by the upload
+        """
+        await self._write("INSERT OR REPLACE INTO media_cache "
+                          "(hash, size, mimetype, content_uri) VALUES (?, ?, ?, ?)",
+                          (digest, size, mimetype, content_uri))
+
+    async def get_cached_result(self, key):
+        """Get a cached script result
+
+        Args:
+            key (str): The cache key of the command
+
+        Returns:
+            tuple: (expires, stdout, stderr) or None if nothing is cached
+        """
+        return await self._fetchone("SELECT expires, stdout, stderr FROM command_cache "
+                                    "WHERE key = ?", (key,))
+
+    async def put_cached_result(self, key, expires, stdout, stderr):
+        """Store a script result until it expires
+
+        Args:
+            key (str): The cache key of the command
+            expires (float): Unix time after which the result is stale
+            stdout (str): Output of the script
+            stderr (str): Error output of the script
+        """
+        await self._write("INSERT OR REPLACE INTO command_cache "
+                          "(key, expires, stdout, stderr) VALUES (?, ?, ?, ?)",
+                          (key, expires, stdout, stderr))
+
+    async def purge_cached_results(self, now):
+        """Delete all script results that expired before now
+
+        Args:
+            now (float): The current unix time
+        """
+        await self._write("DELETE FROM command_cache WHERE expires <= ?", (now,))
+
+    async def add_command_history(self, rows):
+        """Record finished commands
+
+        Args:
+            rows (list): tuples of (ts, alias, script, room_id, sender,
+                queue_wait, run_time, exit_code, output_bytes), see
+                CommandHistory.record()
+        """
+        await self._write("INSERT INTO command_history "
+                          "(ts, alias, script, room_id, sender, queue_wait, run_time, "
+                          "exit_code, output_bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          rows, many=True)
+
+    async def compact_command_history(self, before):
+        """Fold the history older than before into the daily statistics
+
+        The detailed rows are deleted, per day and alias only the number
+        of calls, errors and distinct users and the sums of queue wait, run
+        time and output are kept.
+
+        Args:
+            before (float): Unix time, older rows are compacted
+
+        Returns:
+            int: The number of compacted rows
+        """
+        return await self._run(self._compact_command_history_sync, before)
+
+    def _compact_command_history_sync(self, before):
+        self._commit_sync()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute(
+                "INSERT INTO command_stats "
+                "(day, alias, script, calls, errors, users, queue_wait, run_time, "
+                "max_run_time, output_bytes) "
+                "SELECT date(ts, 'unixepoch') AS d, alias, max(script), count(*), "
+                "sum(exit_code IS NOT NULL AND exit_code != 0), count(DISTINCT sender), "
+                "sum(queue_wait), sum(run_time), max(run_time), "
+                "coalesce(sum(output_bytes), 0) "
+                "FROM command_history WHERE ts < ? GROUP BY d, alias "
+                "ON CONFLICT (day, alias) DO UPDATE SET "
+                "calls = calls + excluded.calls, "
+                "errors = errors + excluded.errors, "
+                "users = max(users, excluded.users), "
+                "queue_wait = queue_wait + excluded.queue_wait, "
+                "run_time = run_time + excluded.run_time, "
+                "max_run_time = max(max_run_time, excluded.max_run_time), "
+                "output_bytes = output_bytes + excluded.output_bytes",
+                (before,))
+            deleted = self.conn.execute(
+                "DELETE FROM command_history WHERE ts < ?", (before,)).rowcount
+            self.conn.execute("COMMIT")
+        except sqlite3.Error:
+            self.conn.execute("ROLLBACK")
+            raise
+        return deleted
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+r"""sync_filter.py.
+
+This file implements the sync filter of the bot
+- the room event types the bot asks for are derived from the event
+  callbacks registered on the client, plus the state events nio needs to
+  keep track of rooms, members and encryption
+- typing notifications, receipts, presence and account data are left out
+  unless a callback for them is registered
+- the timeline of a room is limited, room members can be lazy-loaded
+- the filter is uploaded once, its ID is kept in the Storage under a
+  digest of the filter and reused by every later sync and start
+
+"""
+
+import hashlib
+import json
+import logging
+from typing import Iterable, Optional
+
+from nio import (
+    InviteEvent,
+    MegolmEvent,
+    ReactionEvent,
+    RedactionEvent,
+    RoomMemberEvent,
+    RoomMessage,
+    RoomNameEvent,
+    RoomTopicEvent,
+    UploadFilterResponse,
+)
+
+logger = logging.getLogger(__name__)
+
+# nio event classes and the Matrix event types they are parsed from
+EVENT_TYPES = (
+    (RoomMessage, "m.room.message"),
+    (MegolmEvent, "m.room.encrypted"),
+    (RoomMemberEvent, "m.room.member"),
+    (RedactionEvent, "m.room.redaction"),
+    (ReactionEvent, "m.reaction"),
+    (RoomNameEvent, "m.room.name"),
+    (RoomTopicEvent, "m.room.topic"),
+)
+
+# state nio needs for room names, members and encryption
+STATE_TYPES = (
+    "m.room.create",
+    "m.room.member",
+    "m.room.encryption",
+    "m.room.name",
+    "m.room.canonical_alias",
+    "m.room.join_rules",
+    "m.room.history_visibility",
+    "m.room.power_levels",
+)
+
+# an event filter that lets nothing through
+NOTHING = {"types": []}
+
+
+def _event_types(callbacks) -> Optional[set]:
+    """Matrix event types of the callbacks, None if they can't be told."""
+    types = set()
+    for callback in callbacks:
+        classes = callback.filter
+        if not classes:
+            # a callback for every event
+            return None
+        if isinstance(classes, type):
+            classes = (classes,)
+        for cls in classes:
+            if issubclass(cls, InviteEvent):
+                # invites are never filtered by type
+                continue
+            found = [event_type for base, event_type in EVENT_TYPES
+                     if issubclass(cls, base)]
+            if not found:
+                logger.warning(f"No event type known for {cls.__name__}, "
+                               "the sync timeline is not filtered.")
+                return None
+            types.update(found)
+    return types
+
+
+def _everything_or_nothing(callbacks: Iterable) -> dict:
+    return {} if list(callbacks) else dict(NOTHING)
+
+
+def build_sync_filter(client, timeline_limit: int = 20,
+                      lazy_load_members: bool = False) -> dict:
+    """Build a sync filter for the callbacks registered on client.
+
+    Callbacks registered later are not taken into account, e.g. ones
+    that only count events should be added afterwards.
+
+    Arguments:
+    ---------
+        client (nio.AsyncClient): client with the callbacks registered
+        timeline_limit (int): events per room in the timeline of a sync
+        lazy_load_members (bool): send only the members of a room that
+            sent one of the events of the sync; leaves the member list and
+            count of a room incomplete without a room summary
+
+    Returns the filter as keyword arguments of AsyncClient.upload_filter().
+
+    """
+    timeline = {"limit": timeline_limit}
+    types = _event_types(client.event_callbacks)
+    if types is not None:
+        # encrypted messages and state changes always count
+        types.add("m.room.encrypted")
+        types.update(STATE_TYPES)
+        timeline["types"] = sorted(types)
+    return {
+        "room": {
+            "timeline": timeline,
+            "state": {
+                "types": list(STATE_TYPES),
+                "lazy_load_members": lazy_load_members,
+            },
+            "ephemeral": _everything_or_nothing(client.ephemeral_callbacks),
+            "account_data": _everything_or_nothing(
+                client.room_account_data_callbacks),
+        },
+        "presence": _everything_or_nothing(client.presence_callbacks),
+        "account_data": _everything_or_nothing(
+            client.global_account_data_callbacks),
+    }
+
+
+async def sync_filter_id(client, store, definition: dict) -> Optional[str]:
+    """Return the ID of the filter, upload it if it is not known yet.
+
+    Arguments:
+    ---------
+        client (nio.AsyncClient): logged in client
+        store (Storage): Bot storage the IDs of filters are kept in
+        definition (dict): the filter, see build_sync_filter()
+
+    Returns None if the filter could not be uploaded, sync unfiltered then.
+
+    """
+    digest = hashlib.sha256(
+        json.dumps(definition, sort_keys=True).encode()).hexdigest()
+    filter_id = await store.get_sync_filter(client.user_id, digest)
+    if filter_id is not None:
+        return filter_id
+    response = await client.upload_filter(**definition)
+    if not isinstance(response, UploadFilterResponse):
+        logger.warning(f"Uploading the sync filter failed ({response}), "
+                       "syncing unfiltered.")
+        return None
+    logger.info(f"Uploaded sync filter {response.filter_id}.")
+    await store.put_sync_filter(client.user_id, digest, response.filter_id)
+    return response.filter_id
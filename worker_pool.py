@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+r"""worker_pool.py.
+
+This file implements a pool of warm worker processes for Python scripts
+- every worker is a long-lived interpreter that imported the heavy
+  libraries of the scripts (click, aiohttp, bs4, ...) once at start-up
+- a job runs the script with runpy inside the worker, so the fork/exec
+  and interpreter start-up per command are gone, while a crashing or
+  leaking script still can't take the bot down
+- a worker is replaced after a number of jobs, when its memory passes a
+  limit, when it dies or when a job runs into the timeout; the timeout
+  starts once a worker took the job, waiting for an idle worker is
+  bounded by a timeout of its own
+- a worker that can't be started is retried with a growing delay; while
+  no worker is alive, Python scripts run as subprocesses
+- a job reads stdin from /dev/null, the job channel of the worker is
+  out of reach of scripts and their child processes
+- a job sees a fresh interpreter as far as scripts notice: its own
+  globals, sys.stdout and sys.stdout.buffer capture the output, and
+  sys.path, the working directory and modules imported from next to the
+  script are reset after it; state a script leaves in preloaded or
+  installed libraries survives, such scripts opt out with `pool: false`
+  in aliases.yaml
+
+Started as a program, this file is the worker itself: it reads one JSON
+job per line from stdin and answers with one JSON result line.
+
+"""
+
+import asyncio
+import importlib
+import io
+import json
+import logging
+import os
+import resource
+import runpy
+import shutil
+import sys
+import sysconfig
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from typing import Dict, List, Optional
+
+from executor import ScriptResult
+
+logger = logging.getLogger(__name__)
+
+# imported once by every worker, missing ones are skipped
+PRELOAD_MODULES = [
+    "asyncio", "json", "logging",
+    "aiofiles", "aiohttp", "bs4", "click", "dotenv", "feedparser",
+    "requests",
+]
+
+# limit of a single result line, large script output must fit in it
+RESULT_LIMIT = 64 * 1024 * 1024
+
+# seconds between attempts to start a worker, doubled up to the maximum
+RESPAWN_DELAY = 1
+RESPAWN_MAX_DELAY = 60
+
+# modules loaded from here are kept between jobs, any other module a job
+# imported, e.g. a helper next to the script, is dropped after the job
+LIBRARY_PATHS = tuple(sorted({
+    os.path.realpath(sysconfig.get_paths()[name])
+    for name in ("stdlib", "platstdlib", "purelib", "platlib")}))
+
+
+class _Worker(object):
+    """One worker process and its bookkeeping."""
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.jobs = 0
+        self.maxrss_kb = 0
+
+    def kill(self):
+        if self.proc.returncode is None:
+            self.proc.kill()
+
+
+class WorkerPool(object):
+    """Run Python scripts in pre-started, recycled worker processes."""
+
+    def __init__(self, size: int, max_jobs: int = 100,
+                 max_memory_mb: int = 256):
+        """Initialize.
+
+        Arguments:
+        ---------
+            size (int): number of worker processes
+            max_jobs (int): jobs after which a worker is replaced
+            max_memory_mb (int): peak resident memory in MB after which
+                a worker is replaced
+
+        """
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_memory_mb = max_memory_mb
+        self._idle = asyncio.Queue()
+        self._workers = set()
+        # killed workers that were not awaited yet
+        self._retired = set()
+        self._respawns = set()
+        self._closed = False
+
+    def handles(self, argv: List[str]) -> bool:
+        """Whether the command is a Python script the pool can run now."""
+        return argv[0].endswith(".py") and bool(self._workers)
+
+    async def start(self):
+        """Start all workers, raises OSError if one can't be started."""
+        try:
+            for _ in range(self.size):
+                self._add(await self._spawn())
+        except OSError:
+            await self.close()
+            raise
+
+    async def close(self):
+        """Stop all workers and wait until they are gone."""
+        self._closed = True
+        for task in self._respawns:
+            task.cancel()
+        for worker in self._workers:
+            worker.kill()
+        self._retired.update(self._workers)
+        self._workers.clear()
+        await asyncio.gather(
+            *self._respawns,
+            *(worker.proc.wait() for worker in self._retired),
+            return_exceptions=True)
+        self._retired.clear()
+
+    async def run(self, argv: List[str], env: Dict[str, str],
+                  timeout: Optional[float] = None):
+        """Run a script in the next idle worker.
+
+        Arguments:
+        ---------
+            argv (list): script and its arguments
+            env (dict): environment of the script
+            timeout (float): seconds to wait for an idle worker and, once
+                one took the script, seconds the script may run; None for
+                no limit
+
+        Returns a ScriptResult. Raises asyncio.TimeoutError if either
+        timeout passes. If the script times out or the call is cancelled
+        while it runs, the worker is killed and replaced.
+
+        """
+        worker = await asyncio.wait_for(self._idle.get(), timeout=timeout)
+        try:
+            line = await asyncio.wait_for(
+                self._exchange(worker, argv, env), timeout=timeout)
+        except BaseException:
+            self._retire(worker)
+            raise
+        if not line:
+            self._retire(worker)
+            return ScriptResult(
+                -1, "", f"worker for {argv[0]} died unexpectedly")
+
+        result = json.loads(line)
+        worker.jobs += 1
+        worker.maxrss_kb = result["maxrss_kb"]
+        if (worker.jobs >= self.max_jobs
+                or worker.maxrss_kb > self.max_memory_mb * 1024):
+            logger.debug(
+                f"Recycling worker after {worker.jobs} jobs and "
+                f"{worker.maxrss_kb} kB peak memory.")
+            self._retire(worker)
+        else:
+            self._idle.put_nowait(worker)
+        return ScriptResult(
+            result["returncode"], result["stdout"], result["stderr"])
+
+    async def _exchange(self, worker: _Worker, argv: List[str],
+                        env: Dict[str, str]) -> bytes:
+        job = json.dumps({"argv": argv, "env": env}) + "\n"
+        worker.proc.stdin.write(job.encode())
+        await worker.proc.stdin.drain()
+        return await worker.proc.stdout.readline()
+
+    def _retire(self, worker: _Worker):
+        worker.kill()
+        self._workers.discard(worker)
+        self._retired.add(worker)
+        reaper = asyncio.ensure_future(worker.proc.wait())
+        reaper.add_done_callback(lambda _: self._retired.discard(worker))
+        if not self._closed:
+            task = asyncio.ensure_future(self._replace())
+            self._respawns.add(task)
+            task.add_done_callback(self._respawns.discard)
+
+    async def _replace(self):
+        """Start a worker, retrying with a growing delay until it runs."""
+        delay = RESPAWN_DELAY
+        while True:
+            try:
+                self._add(await self._spawn())
+                return
+            except OSError:
+                logger.exception(
+                    f"Starting a script worker failed, retrying in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RESPAWN_MAX_DELAY)
+
+    async def _spawn(self):
+        return await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            limit=RESULT_LIMIT,
+        )
+
+    def _add(self, proc):
+        worker = _Worker(proc)
+        self._workers.add(worker)
+        self._idle.put_nowait(worker)
+
+
+def _run_job(argv: List[str], env: Dict[str, str]) -> dict:
+    """Run a script like a fresh interpreter would, capturing its output."""
+    path = shutil.which(argv[0], path=env.get("PATH")) or argv[0]
+    os.environ.clear()
+    os.environ.update(env)
+    sys.argv = [path] + argv[1:]
+    # scripts get no input, the job channel is not theirs to read
+    stdin = sys.stdin = open(os.devnull)
+    saved_path = list(sys.path)
+    saved_cwd = os.getcwd()
+    saved_modules = set(sys.modules)
+    # like `python script.py`, modules next to the script can be imported
+    sys.path.insert(0, os.path.dirname(os.path.realpath(path)))
+    # text streams over bytes, like the real ones, for scripts that write
+    # to sys.stdout.buffer
+    stdout, stderr = _capture(), _capture()
+    returncode = 0
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            runpy.run_path(path, run_name="__main__")
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                returncode = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                returncode = 1
+        except BaseException:
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            sys.path[:] = saved_path
+            os.chdir(saved_cwd)
+            _drop_script_modules(set(sys.modules) - saved_modules)
+            stdin.close()
+    return {
+        "returncode": returncode,
+        "stdout": _captured(stdout),
+        "stderr": _captured(stderr),
+        "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _capture() -> io.TextIOWrapper:
+    return io.TextIOWrapper(io.BytesIO(), encoding="utf-8",
+                            errors="replace", write_through=True)
+
+
+def _captured(stream: io.TextIOWrapper) -> str:
+    stream.flush()
+    return stream.buffer.getvalue().decode("utf-8", errors="replace")
+
+
+def _drop_script_modules(names):
+    """Forget the modules a job imported from outside the libraries."""
+    for name in names:
+        path = getattr(sys.modules.get(name), "__file__", None)
+        if path is None or not os.path.realpath(path).startswith(
+                LIBRARY_PATHS):
+            sys.modules.pop(name, None)
+
+
+def _worker_main():
+    # Keep the real stdin and stdout for jobs and results only, anything
+    # else that uses file descriptor 0 or 1 (e.g. a child process of a
+    # script) reads and writes nowhere.
+    jobs = os.fdopen(os.dup(0), "r")
+    results = os.fdopen(os.dup(1), "w")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    for line in jobs:
+        job = json.loads(line)
+        results.write(json.dumps(_run_job(job["argv"], job["env"])) + "\n")
+        results.flush()
+
+
+if __name__ == "__main__":
+    _worker_main()